@@ -0,0 +1,93 @@
+import hashlib
+import json
+import logging
+import os
+import re
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from cache import TTLCache
+from search_index import normalize_arabic
+
+logger = logging.getLogger(__name__)
+
+_SPACE_RE = re.compile(r"\s+")
+_TRAILING_RE = re.compile(r"[\s?؟.!،,]+$")
+
+
+def normalize_prompt(text: str) -> str:
+    text = normalize_arabic(text or "")
+    return _TRAILING_RE.sub("", _SPACE_RE.sub(" ", text).strip())
+
+
+def cache_key(system_message: Optional[str], provider: str, model: str, prompt: str) -> str:
+    raw = json.dumps([system_message or "", provider, model, normalize_prompt(prompt)], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class AIResponseCache:
+    """Exact-match cache of model answers, in process and in Mongo.
+
+    The first tier is a per-worker LRU; misses fall through to
+    ``ai_response_cache``, which every worker shares and Mongo's TTL monitor
+    expires via the ``expires_at`` index.
+    """
+
+    def __init__(self, db, maxsize: int = None, ttl: float = None):
+        self.db = db
+        self.ttl = float(os.getenv("AI_CACHE_TTL", 86400)) if ttl is None else ttl
+        self.memory = TTLCache(maxsize=maxsize or int(os.getenv("AI_CACHE_SIZE", 1000)), ttl=self.ttl)
+        self.counters = {"memory_hits": 0, "shared_hits": 0, "misses": 0, "stores": 0, "bypassed": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    async def get(self, key: str) -> Optional[str]:
+        response = self.memory.get(key)
+        if response is not None:
+            self.counters["memory_hits"] += 1
+            return response
+
+        now = datetime.now(timezone.utc)
+        try:
+            doc = await self.db.ai_response_cache.find_one({"_id": key, "expires_at": {"$gt": now}})
+        except Exception as e:
+            logger.warning(f"AI cache lookup failed: {e}")
+            doc = None
+        if not doc:
+            self.counters["misses"] += 1
+            return None
+
+        self.counters["shared_hits"] += 1
+        expires_at = doc["expires_at"]
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        self.memory.set(key, doc["response"], ttl=(expires_at - now).total_seconds())
+        return doc["response"]
+
+    async def set(self, key: str, response: str):
+        self.memory.set(key, response)
+        self.counters["stores"] += 1
+        now = datetime.now(timezone.utc)
+        try:
+            await self.db.ai_response_cache.update_one(
+                {"_id": key},
+                {"$set": {"response": response, "created_at": now, "expires_at": now + timedelta(seconds=self.ttl)}},
+                upsert=True
+            )
+        except Exception as e:
+            logger.warning(f"AI cache store failed: {e}")
+
+    def bypass(self):
+        self.counters["bypassed"] += 1
+
+    def stats(self) -> dict:
+        lookups = self.counters["memory_hits"] + self.counters["shared_hits"] + self.counters["misses"]
+        hits = lookups - self.counters["misses"]
+        return {
+            **self.counters,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "memory_entries": len(self.memory),
+            "ttl": self.ttl
+        }
@@ -0,0 +1,207 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+from cache import TTLCache
+
+
+class AIRejected(Exception):
+    def __init__(self, status_code: int, detail: str, retry_after: Optional[float] = None):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Take one token; returns 0 on success, else seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class CircuitBreaker:
+    """Opens after ``threshold`` consecutive failures, then lets one probe through per ``reset_after``."""
+
+    def __init__(self, threshold: int, reset_after: float):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probe_started: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.reset_after else "open"
+
+    def allow(self) -> float:
+        """0 if a call may go ahead, else seconds until the next probe."""
+        state = self.state
+        if state == "closed":
+            return 0.0
+        now = time.monotonic()
+        # A probe that never reported back (client went away) expires too
+        if state == "half_open" and (self.probe_started is None or now - self.probe_started >= self.reset_after):
+            self.probe_started = now
+            return 0.0
+        return max(self.reset_after - (now - self.opened_at), 1.0)
+
+    def record(self, failed: bool):
+        self.probe_started = None
+        if not failed:
+            self.failures = 0
+            self.opened_at = None
+            return
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+
+class AIGate:
+    """Admission control in front of the model provider.
+
+    A call must pass the provider's circuit breaker and the user's token
+    bucket, then wait (up to ``queue_timeout``) for a per-company and a
+    global concurrency slot. Rejections are raised as ``AIRejected`` with
+    a suggested retry delay.
+    """
+
+    def __init__(self, max_concurrent: int = None, tenant_concurrent: int = None, queue_timeout: float = None,
+                 user_rate: float = None, user_burst: int = None, failure_threshold: int = None,
+                 reset_after: float = None):
+        self.max_concurrent = max_concurrent or int(os.getenv("AI_MAX_CONCURRENT", 16))
+        self.tenant_concurrent = tenant_concurrent or int(os.getenv("AI_TENANT_CONCURRENT", 4))
+        self.queue_timeout = queue_timeout or float(os.getenv("AI_QUEUE_TIMEOUT", 15))
+        # Requests per minute, refilled continuously
+        self.user_rate = (user_rate or float(os.getenv("AI_USER_RATE", 20))) / 60
+        self.user_burst = user_burst or int(os.getenv("AI_USER_BURST", 10))
+        self.failure_threshold = failure_threshold or int(os.getenv("AI_BREAKER_FAILURES", 5))
+        self.reset_after = reset_after or float(os.getenv("AI_BREAKER_RESET", 30))
+
+        self._global = asyncio.Semaphore(self.max_concurrent)
+        self._tenants = TTLCache(maxsize=10000, ttl=3600)
+        self._buckets = TTLCache(maxsize=10000, ttl=3600)
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self.in_flight = 0
+        self.queued = 0
+        self.tenant_queued: Dict[str, int] = {}
+        self.counters = {"admitted": 0, "completed": 0, "failed": 0, "rejected_quota": 0,
+                         "rejected_queue_timeout": 0, "rejected_circuit_open": 0}
+
+    def _breaker(self, provider: str) -> CircuitBreaker:
+        breaker = self._breakers.get(provider)
+        if breaker is None:
+            breaker = self._breakers[provider] = CircuitBreaker(self.failure_threshold, self.reset_after)
+        return breaker
+
+    def _bucket(self, user_id: str) -> TokenBucket:
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = TokenBucket(self.user_rate, self.user_burst)
+        self._buckets.set(user_id, bucket)
+        return bucket
+
+    def admit(self, user_id: str, provider: str):
+        """Fail fast on an open circuit or an empty quota, before any queueing."""
+        wait = self._breaker(provider).allow()
+        if wait:
+            self.counters["rejected_circuit_open"] += 1
+            raise AIRejected(503, "AI provider is unavailable, try again shortly", wait)
+
+        wait = self._bucket(user_id).take()
+        if wait:
+            self.counters["rejected_quota"] += 1
+            raise AIRejected(429, "AI request quota exceeded", wait)
+
+    def _tenant(self, tenant_id: str) -> asyncio.Semaphore:
+        tenant = self._tenants.get(tenant_id)
+        if tenant is None:
+            tenant = asyncio.Semaphore(self.tenant_concurrent)
+        self._tenants.set(tenant_id, tenant)
+        return tenant
+
+    async def _acquire(self, tenant_id: str) -> asyncio.Semaphore:
+        tenant = self._tenant(tenant_id)
+        deadline = time.monotonic() + self.queue_timeout
+        self.queued += 1
+        self.tenant_queued[tenant_id] = self.tenant_queued.get(tenant_id, 0) + 1
+        try:
+            await asyncio.wait_for(tenant.acquire(), self.queue_timeout)
+            try:
+                await asyncio.wait_for(self._global.acquire(), max(deadline - time.monotonic(), 0.001))
+            except BaseException:
+                tenant.release()
+                raise
+        except asyncio.TimeoutError:
+            self.counters["rejected_queue_timeout"] += 1
+            raise AIRejected(503, "AI service is busy, try again shortly", self.queue_timeout)
+        finally:
+            self.queued -= 1
+            self.tenant_queued[tenant_id] -= 1
+            if not self.tenant_queued[tenant_id]:
+                del self.tenant_queued[tenant_id]
+
+        self.in_flight += 1
+        self.counters["admitted"] += 1
+        return tenant
+
+    def _release(self, tenant: asyncio.Semaphore, provider: str, failed: Optional[bool]):
+        # Release the semaphore that was acquired, even if the cache has since evicted it
+        self.in_flight -= 1
+        self._global.release()
+        tenant.release()
+        if failed is None:
+            return
+        self.counters["failed" if failed else "completed"] += 1
+        self._breaker(provider).record(failed)
+
+    @asynccontextmanager
+    async def running(self, tenant_id: str, provider: str, is_failure=lambda e: True):
+        """Hold a concurrency slot for an admitted call and report its outcome to the breaker."""
+        tenant = await self._acquire(tenant_id)
+        failed = None
+        try:
+            yield
+            failed = False
+        except Exception as e:
+            failed = True if is_failure(e) else None
+            raise
+        finally:
+            # Cancelled calls (client disconnects) and errors that aren't the
+            # provider's say nothing about it, so they leave the breaker alone
+            self._release(tenant, provider, failed)
+
+    @asynccontextmanager
+    async def slot(self, user_id: str, tenant_id: str, provider: str, is_failure=lambda e: True):
+        self.admit(user_id, provider)
+        async with self.running(tenant_id, provider, is_failure):
+            yield
+
+    def metrics(self) -> dict:
+        return {
+            **self.counters,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "queued_by_company": dict(self.tenant_queued),
+            "max_concurrent": self.max_concurrent,
+            "tenant_concurrent": self.tenant_concurrent,
+            "circuits": {
+                provider: {"state": breaker.state, "consecutive_failures": breaker.failures}
+                for provider, breaker in self._breakers.items()
+            }
+        }
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from pymongo import ReturnDocument
+
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+class AuthCache:
+    """In-process user cache plus a compact map of claim revocations.
+
+    Tokens carry ``ver``, the user's ``token_version`` at issue time. When a
+    user's role or company changes the version is bumped and recorded in
+    ``token_revocations``; every worker polls that collection, so tokens
+    issued before the bump stop being trusted on their claims alone and are
+    re-validated against the (cached) user record instead. Profile edits
+    that leave the claims alone go through the same collection without a
+    version bump, so every worker drops its cached copy of the user.
+    """
+
+    def __init__(self, db, ttl: float = None, maxsize: int = None, sync_interval: float = None):
+        self.db = db
+        self.users = TTLCache(
+            maxsize=maxsize or int(os.getenv("AUTH_CACHE_SIZE", 10000)),
+            ttl=ttl or float(os.getenv("AUTH_CACHE_TTL", 300))
+        )
+        self.sync_interval = sync_interval or float(os.getenv("AUTH_REVOCATION_SYNC", 5))
+        self.versions: Dict[str, int] = {}
+        self._synced_at = ""
+        self._task = None
+
+    def is_current(self, user_id: str, token_version: int) -> bool:
+        return token_version >= self.versions.get(user_id, 0)
+
+    async def get_user(self, user_id: str) -> Optional[dict]:
+        user_doc = self.users.get(user_id)
+        if user_doc is None:
+            user_doc = await self.db.users.find_one({"id": user_id}, {"_id": 0})
+            if user_doc:
+                self.users.set(user_id, user_doc)
+        return user_doc
+
+    def invalidate(self, user_id: str):
+        self.users.pop(user_id)
+
+    async def publish_invalidation(self, user_id: str):
+        """Drop the cached user record here and, on the next sync, in every worker."""
+        self.invalidate(user_id)
+        await self.db.token_revocations.update_one(
+            {"user_id": user_id},
+            {"$set": {"user_id": user_id, "updated_at": datetime.now(timezone.utc).isoformat()},
+             "$setOnInsert": {"token_version": 0}},
+            upsert=True
+        )
+
+    async def revoke_claims(self, user_id: str):
+        user_doc = await self.db.users.find_one_and_update(
+            {"id": user_id},
+            {"$inc": {"token_version": 1}},
+            projection={"_id": 0, "token_version": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        self.invalidate(user_id)
+        if not user_doc:
+            return
+        version = user_doc["token_version"]
+        self.versions[user_id] = max(self.versions.get(user_id, 0), version)
+        await self.db.token_revocations.update_one(
+            {"user_id": user_id},
+            {"$set": {
+                "user_id": user_id,
+                "token_version": version,
+                "updated_at": datetime.now(timezone.utc).isoformat()
+            }},
+            upsert=True
+        )
+
+    async def sync(self):
+        query = {"updated_at": {"$gt": self._synced_at}} if self._synced_at else {}
+        async for entry in self.db.token_revocations.find(query, {"_id": 0}).sort("updated_at", 1):
+            user_id = entry["user_id"]
+            if entry["token_version"] > self.versions.get(user_id, 0):
+                self.versions[user_id] = entry["token_version"]
+            # Every entry newer than the last sync means the user record changed
+            self.invalidate(user_id)
+            self._synced_at = entry["updated_at"]
+
+    async def _sync_loop(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.sync()
+            except Exception as e:
+                logger.warning(f"Token revocation sync failed: {e}")
+
+    async def start(self):
+        await self.sync()
+        self._task = asyncio.create_task(self._sync_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
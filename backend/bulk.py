@@ -0,0 +1,59 @@
+import os
+from typing import List, Tuple, Type
+
+from pydantic import BaseModel, ValidationError
+from pymongo.errors import BulkWriteError
+
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", 5000))
+BATCH_SIZE = 1000
+
+
+def _validation_message(error: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(part) for part in e['loc']) or 'item'}: {e['msg']}" for e in error.errors()
+    )
+
+
+class BulkReport:
+    """Per-item outcome of a bulk request, keyed by the item's index in the payload."""
+
+    def __init__(self, size: int):
+        self.results = [None] * size
+
+    def ok(self, index: int, doc_id: str):
+        self.results[index] = {"index": index, "ok": True, "id": doc_id}
+
+    def error(self, index: int, message: str):
+        self.results[index] = {"index": index, "ok": False, "error": message}
+
+    def validate(self, items: List[dict], model: Type[BaseModel]) -> List[Tuple[int, BaseModel]]:
+        valid = []
+        for index, item in enumerate(items):
+            try:
+                valid.append((index, model.model_validate(item)))
+            except ValidationError as e:
+                self.error(index, _validation_message(e))
+        return valid
+
+    def as_dict(self) -> dict:
+        created = sum(1 for r in self.results if r and r["ok"])
+        return {"created": created, "failed": len(self.results) - created, "results": self.results}
+
+
+async def insert_unordered(collection, rows: List[Tuple[int, dict]], report: BulkReport) -> List[dict]:
+    """insert_many(ordered=False) in batches; returns the documents that were written."""
+    written = []
+    for start in range(0, len(rows), BATCH_SIZE):
+        batch = rows[start:start + BATCH_SIZE]
+        failed = {}
+        try:
+            await collection.insert_many([dict(doc) for _, doc in batch], ordered=False)
+        except BulkWriteError as e:
+            failed = {err["index"]: err.get("errmsg", "write failed") for err in e.details.get("writeErrors", [])}
+        for position, (index, doc) in enumerate(batch):
+            if position in failed:
+                report.error(index, failed[position])
+            else:
+                report.ok(index, doc["id"])
+                written.append(doc)
+    return written
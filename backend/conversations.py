@@ -0,0 +1,169 @@
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+BUCKET_SIZE = int(os.getenv("AI_MESSAGE_BUCKET", 50))
+CONTEXT_TOKENS = int(os.getenv("AI_CONTEXT_TOKENS", 4000))
+SUMMARY_TRIGGER_TOKENS = int(os.getenv("AI_SUMMARY_TRIGGER_TOKENS", 1500))
+CHARS_PER_TOKEN = float(os.getenv("AI_CHARS_PER_TOKEN", 3))
+MAX_SUMMARY_MESSAGES = 200
+
+
+def estimate_tokens(text: str) -> int:
+    # Rough count; Arabic text runs closer to 3 characters per token than 4
+    return int(len(text or "") / CHARS_PER_TOKEN) + 4
+
+
+def _flatten(messages: list) -> List[dict]:
+    # Older turns were pushed as [user, assistant] pairs
+    flat = []
+    for item in messages:
+        flat.extend(item if isinstance(item, list) else [item])
+    return flat
+
+
+class ConversationStore:
+    """AI conversation history kept in ``ai_messages`` buckets.
+
+    Each message gets a sequence number from ``message_count`` on the
+    conversation and lands in bucket ``seq // bucket_size``, so no single
+    document grows without bound and recent history is read from the last
+    few buckets only. Turns that fall out of the context window are folded
+    into a rolling ``summary`` on the conversation.
+    """
+
+    def __init__(self, db, bucket_size: int = BUCKET_SIZE, context_tokens: int = CONTEXT_TOKENS):
+        self.db = db
+        self.bucket_size = bucket_size
+        self.context_tokens = context_tokens
+        self._summarizing = set()
+
+    async def append(self, conversation_id: str, messages: List[dict]) -> List[dict]:
+        if not messages:
+            return []
+        conv = await self.db.ai_conversations.find_one_and_update(
+            {"id": conversation_id},
+            {"$inc": {"message_count": len(messages)}},
+            projection={"_id": 0, "message_count": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if not conv:
+            return []
+        first = conv["message_count"] - len(messages)
+        stored = [{**m, "seq": first + i} for i, m in enumerate(messages)]
+
+        by_bucket: Dict[int, List[dict]] = {}
+        for message in stored:
+            by_bucket.setdefault(message["seq"] // self.bucket_size, []).append(message)
+        now = datetime.now(timezone.utc).isoformat()
+        for bucket, items in by_bucket.items():
+            await self.db.ai_messages.update_one(
+                {"conversation_id": conversation_id, "bucket": bucket},
+                {"$push": {"messages": {"$each": items}}, "$inc": {"count": len(items)}, "$set": {"updated_at": now}},
+                upsert=True
+            )
+        return stored
+
+    async def migrate_legacy(self, conversation_id: str):
+        # Move an embedded messages array into buckets; only one caller wins the $unset
+        conv = await self.db.ai_conversations.find_one_and_update(
+            {"id": conversation_id, "messages.0": {"$exists": True}},
+            {"$unset": {"messages": ""}},
+            projection={"_id": 0, "messages": 1}
+        )
+        if conv:
+            await self.append(conversation_id, _flatten(conv["messages"]))
+
+    async def page(self, conversation_id: str, limit: int, before: Optional[int] = None) -> Tuple[List[dict], Optional[int]]:
+        """Up to ``limit`` messages older than ``before``, oldest first, and the next ``before``."""
+        query = {"conversation_id": conversation_id}
+        if before is not None:
+            query["bucket"] = {"$lte": (before - 1) // self.bucket_size}
+        cursor = self.db.ai_messages.find(query, {"_id": 0, "messages": 1}).sort("bucket", -1)
+
+        collected: List[dict] = []
+        async for bucket in cursor:
+            messages = [m for m in bucket["messages"] if before is None or m["seq"] < before]
+            collected = sorted(messages, key=lambda m: m["seq"]) + collected
+            if len(collected) >= limit:
+                break
+        messages = collected[-limit:] if limit else []
+        next_before = messages[0]["seq"] if messages and messages[0]["seq"] > 0 else None
+        return messages, next_before
+
+    def _budget(self, conv: Optional[dict]) -> int:
+        # Whatever the summary does not use goes to recent turns
+        summary = (conv or {}).get("summary")
+        return max(self.context_tokens - (estimate_tokens(summary) if summary else 0), 0)
+
+    async def _window(self, conversation_id: str, budget: int) -> Tuple[List[dict], int]:
+        # Newest messages that fit the budget, and the first seq included
+        window: List[dict] = []
+        used = 0
+        before = None
+        while True:
+            messages, before = await self.page(conversation_id, self.bucket_size, before)
+            for message in reversed(messages):
+                cost = estimate_tokens(message["content"])
+                if used + cost > budget:
+                    return window, message["seq"] + 1
+                window.insert(0, message)
+                used += cost
+            if before is None:
+                return window, 0
+
+    async def build_context(self, conversation_id: str) -> List[dict]:
+        """Chat messages for the model: the rolling summary plus the latest turns within budget."""
+        conv = await self.db.ai_conversations.find_one(
+            {"id": conversation_id}, {"_id": 0, "summary": 1, "summary_upto": 1}
+        ) or {}
+        context = []
+        if conv.get("summary"):
+            context.append({"role": "system", "content": f"ملخص المحادثة السابقة:\n{conv['summary']}"})
+        window, _ = await self._window(conversation_id, self._budget(conv))
+        upto = conv.get("summary_upto", 0)
+        return context + [{"role": m["role"], "content": m["content"]} for m in window if m["seq"] >= upto]
+
+    async def maybe_summarize(self, conversation_id: str, summarize: Callable[[Optional[str], List[dict]], Awaitable[str]]):
+        """Fold turns that left the context window into the conversation summary.
+
+        Runs only once enough unsummarized text has accumulated, and at most
+        once at a time per conversation.
+        """
+        if conversation_id in self._summarizing:
+            return
+        self._summarizing.add(conversation_id)
+        try:
+            conv = await self.db.ai_conversations.find_one(
+                {"id": conversation_id}, {"_id": 0, "summary": 1, "summary_upto": 1}
+            )
+            if not conv:
+                return
+            upto = conv.get("summary_upto", 0)
+            _, window_start = await self._window(conversation_id, self._budget(conv))
+            if window_start <= upto:
+                return
+
+            pending: List[dict] = []
+            before = window_start
+            while before is not None and before > upto:
+                messages, before = await self.page(conversation_id, self.bucket_size, before)
+                pending = [m for m in messages if m["seq"] >= upto] + pending
+            pending = pending[:MAX_SUMMARY_MESSAGES]
+            if sum(estimate_tokens(m["content"]) for m in pending) < SUMMARY_TRIGGER_TOKENS:
+                return
+
+            summary = await summarize(conv.get("summary"), pending)
+            await self.db.ai_conversations.update_one(
+                {"id": conversation_id, "summary_upto": conv.get("summary_upto")},
+                {"$set": {"summary": summary, "summary_upto": pending[-1]["seq"] + 1}}
+            )
+        except Exception as e:
+            logger.warning(f"Summarizing conversation {conversation_id} failed: {e}")
+        finally:
+            self._summarizing.discard(conversation_id)
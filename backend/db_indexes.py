@@ -0,0 +1,145 @@
+import logging
+from typing import Dict, List
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+
+def _unique(*fields) -> IndexModel:
+    return IndexModel([(f, ASCENDING) for f in fields], unique=True)
+
+
+def _index(*keys) -> IndexModel:
+    return IndexModel([k if isinstance(k, tuple) else (k, ASCENDING) for k in keys])
+
+
+# Every collection the API touches, with the indexes its hot paths need.
+INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [_unique("id"), _unique("email"), _index("company_id")],
+    "companies": [_unique("id")],
+    "cases": [
+        _unique("id"), _index("company_id", "status"), _index("company_id", "created_at", "id"),
+        _index("user_id", "created_at", "id"), _index("type")
+    ],
+    "sessions": [
+        _unique("id"), _index("case_id", "session_date", "id"), _index("case_id", "session_at", "id"),
+        _index("company_id", "session_at", "id"), _index("user_id", "session_at", "id"),
+        _index("session_at", "id")
+    ],
+    "documents": [_unique("id"), _index("case_id", "uploaded_at", "id"), _index("sha256")],
+    "invoices": [
+        _unique("id"), _index("case_id", "issued_date", "id"), _index("company_id", "type", "invoice_number"),
+        _index("company_id", "status")
+    ],
+    "payments": [_unique("id"), _index("case_id", "payment_date", "id"), _index("invoice_id")],
+    "templates": [_unique("id"), _index("company_id", "created_at", "id"), _index("company_id", "type")],
+    "ai_conversations": [_unique("id"), _index("user_id")],
+    "ai_messages": [_unique("conversation_id", "bucket")],
+    "ai_response_cache": [IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0)],
+    "api_keys": [_unique("user_id")],
+    "drive_credentials": [_unique("user_id")],
+    "token_revocations": [_unique("user_id"), _index("updated_at")],
+    "blobs": [_unique("sha256")],
+    "ocr_jobs": [_unique("sha256"), _index("status", "created_at")],
+    "drive_jobs": [_unique("doc_id"), _index("status", "next_attempt_at"), _index("user_id", "status")],
+    "document_pages": [_unique("sha256", "page")],
+    "search_postings": [_index("term", ("tf", DESCENDING)), _index("doc_id")],
+    "search_terms": [_unique("term")],
+    "search_docs": [_unique("doc_id")],
+    "case_passages": [_unique("id"), _index("doc_id")],
+    "case_passage_postings": [_index("case_id", "term", ("tf", DESCENDING)), _index("doc_id")],
+}
+
+# (name, collection, filter, sort) for each query the endpoints issue.
+QUERY_SHAPES = [
+    ("get_current_user", "users", {"id": "x"}, None),
+    ("login", "users", {"email": "x@example.com"}, None),
+    ("get_company", "companies", {"id": "x"}, None),
+    ("get_cases:user", "cases", {"user_id": "x"}, [("created_at", 1), ("id", 1)]),
+    ("get_cases:company", "cases", {"company_id": "x"}, [("created_at", 1), ("id", 1)]),
+    ("get_stats:active_cases", "cases", {"company_id": "x", "status": "active"}, None),
+    ("get_case", "cases", {"id": "x"}, None),
+    ("search_documents:case_type", "cases", {"type": "x"}, None),
+    ("get_sessions", "sessions", {"case_id": "x"}, [("session_date", 1), ("id", 1)]),
+    ("update_session", "sessions", {"id": "x"}, None),
+    ("case_overview:sessions", "sessions", {"case_id": "x", "session_at": {"$gte": "a"}}, [("session_at", 1), ("id", 1)]),
+    ("session_calendar:company", "sessions", {"company_id": "x", "session_at": {"$gte": "a", "$lt": "b"}}, [("session_at", 1), ("id", 1)]),
+    ("session_calendar:user", "sessions", {"user_id": "x", "session_at": {"$gte": "a", "$lt": "b"}}, [("session_at", 1), ("id", 1)]),
+    ("get_documents", "documents", {"case_id": "x"}, [("uploaded_at", 1), ("id", 1)]),
+    ("download_document", "documents", {"id": "x"}, None),
+    ("documents_by_blob", "documents", {"sha256": "x"}, None),
+    ("invoice_number_seed", "invoices", {"company_id": "x", "type": "fees", "invoice_number": {"$regex": "^FEES-2026-"}}, [("invoice_number", -1)]),
+    ("get_invoices", "invoices", {"case_id": "x"}, [("issued_date", 1), ("id", 1)]),
+    ("update_invoice", "invoices", {"id": "x"}, None),
+    ("get_stats:invoices", "invoices", {"company_id": "x"}, None),
+    ("get_payments", "payments", {"case_id": "x"}, [("payment_date", 1), ("id", 1)]),
+    ("invoice_payments", "payments", {"invoice_id": "x"}, None),
+    ("get_templates", "templates", {"company_id": "x", "type": "x"}, [("created_at", 1), ("id", 1)]),
+    ("get_conversation", "ai_conversations", {"id": "x"}, None),
+    ("conversation_messages", "ai_messages", {"conversation_id": "x", "bucket": {"$lte": 1}}, [("bucket", -1)]),
+    ("ai_response_cache", "ai_response_cache", {"_id": "x", "expires_at": {"$gt": "x"}}, None),
+    ("api_keys", "api_keys", {"user_id": "x"}, None),
+    ("drive_credentials", "drive_credentials", {"user_id": "x"}, None),
+    ("token_revocations:sync", "token_revocations", {"updated_at": {"$gt": "x"}}, [("updated_at", 1)]),
+    ("blob_lookup", "blobs", {"sha256": "x"}, None),
+    ("ocr_claim", "ocr_jobs", {"status": "pending", "$or": [{"not_before": None}, {"not_before": {"$lte": "x"}}]}, [("created_at", 1)]),
+    ("drive_claim", "drive_jobs", {"status": "pending", "next_attempt_at": {"$lte": "x"}}, [("next_attempt_at", 1)]),
+    ("drive_sync_status", "drive_jobs", {"user_id": "x", "status": {"$in": ["pending"]}}, [("updated_at", -1)]),
+    ("document_pages", "document_pages", {"sha256": "x", "page": {"$gte": 1}}, [("page", 1)]),
+    ("search_postings", "search_postings", {"term": "x"}, [("tf", -1)]),
+    ("search_terms", "search_terms", {"term": {"$in": ["x"]}}, None),
+    ("search_docs", "search_docs", {"doc_id": {"$in": ["x"]}}, None),
+    ("case_passage_postings", "case_passage_postings", {"case_id": "x", "term": "x"}, [("tf", -1)]),
+    ("case_passages", "case_passages", {"id": {"$in": ["x"]}}, None),
+    ("remove_passages", "case_passages", {"doc_id": "x"}, None),
+]
+
+
+async def ensure_indexes(db) -> List[str]:
+    """Create every index and return the collections where that failed.
+
+    A unique index cannot be built over existing duplicates (DuplicateKeyError
+    is an OperationFailure); that is logged and the other collections still
+    get their indexes, so the API can start. ``manage.py check-indexes``
+    fails on it.
+    """
+    failures = []
+    # create_indexes is a no-op for indexes that already exist with the same spec
+    for collection, models in INDEXES.items():
+        try:
+            names = await db[collection].create_indexes(models)
+        except OperationFailure as e:
+            failures.append(collection)
+            logger.error(f"Could not build indexes on {collection}: {e}")
+            continue
+        logger.info(f"Indexes ready on {collection}: {', '.join(names)}")
+    return failures
+
+
+def _has_collscan(plan) -> bool:
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            return True
+        return any(_has_collscan(v) for v in plan.values())
+    if isinstance(plan, list):
+        return any(_has_collscan(v) for v in plan)
+    return False
+
+
+async def check_query_plans(db) -> List[str]:
+    """Explain every registered query shape and return the ones that COLLSCAN."""
+    failures = []
+    for name, collection, query, sort in QUERY_SHAPES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain = await cursor.explain()
+        winning_plan = explain.get("queryPlanner", {}).get("winningPlan", {})
+        if _has_collscan(winning_plan):
+            failures.append(name)
+            logger.error(f"{name}: COLLSCAN on {collection} for {query}")
+        else:
+            logger.info(f"{name}: ok")
+    return failures
@@ -0,0 +1,169 @@
+import hashlib
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from mimetypes import guess_type
+from typing import List, Optional, Tuple
+from urllib.parse import quote
+
+from fastapi import HTTPException, Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
+
+from cache import TTLCache
+
+# Stored files never change in place (new content gets a new blob), so clients may keep them
+CACHE_CONTROL = os.getenv("DOWNLOAD_CACHE_CONTROL", "private, max-age=31536000, immutable")
+
+
+class DocumentFileCache:
+    """doc_id -> download metadata (key, name, size, mtime, ETag), so repeat opens skip the storage stat.
+
+    A hit still checks that the document exists: a delete handled by another
+    worker only invalidates that worker's cache.
+    """
+
+    def __init__(self, db, storage, maxsize: int = None, ttl: float = None):
+        self.db = db
+        self.storage = storage
+        self.entries = TTLCache(
+            maxsize=maxsize or int(os.getenv("DOWNLOAD_META_CACHE_SIZE", 5000)),
+            ttl=ttl or float(os.getenv("DOWNLOAD_META_CACHE_TTL", 600))
+        )
+
+    async def get(self, doc_id: str) -> Optional[dict]:
+        meta = self.entries.get(doc_id)
+        if meta is not None:
+            if await self.db.documents.find_one({"id": doc_id}, {"_id": 1}) is None:
+                self.entries.pop(doc_id)
+                return None
+            return meta
+
+        doc = await self.db.documents.find_one(
+            {"id": doc_id}, {"_id": 0, "storage_key": 1, "file_name": 1, "sha256": 1}
+        )
+        if not doc:
+            return None
+        stat = await self.storage.stat(doc["storage_key"]) if doc.get("storage_key") else None
+        if stat is None:
+            return {**doc, "missing": True}
+
+        # Strong validator: the content hash, or size+mtime for files stored before hashing
+        tag = doc.get("sha256") or hashlib.sha256(f"{stat['size']}-{stat['mtime']}".encode()).hexdigest()
+        meta = {
+            **doc,
+            "size": stat["size"],
+            "mtime": stat["mtime"],
+            "etag": f'"{tag}"',
+            "last_modified": formatdate(stat["mtime"], usegmt=True)
+        }
+        self.entries.set(doc_id, meta)
+        return meta
+
+    def invalidate(self, doc_id: str):
+        self.entries.pop(doc_id)
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    tags = [t.strip() for t in header.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+def _not_modified_since(header: str, mtime: float) -> bool:
+    try:
+        return int(mtime) <= parsedate_to_datetime(header).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+def parse_range(header: str, size: int) -> Optional[List[Tuple[int, int]]]:
+    """Byte ranges as inclusive (start, end) pairs; None if the header is malformed or not bytes."""
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec:
+        return None
+    ranges = []
+    for part in spec.split(","):
+        start, sep, end = part.strip().partition("-")
+        if not sep:
+            return None
+        try:
+            if start:
+                first, last = int(start), int(end) if end else size - 1
+            else:
+                suffix = int(end)
+                if suffix == 0:
+                    continue
+                first, last = max(size - suffix, 0), size - 1
+        except ValueError:
+            return None
+        if first > last and end:
+            return None
+        ranges.append((first, min(last, size - 1)))
+    return ranges
+
+
+def _content_disposition(filename: str) -> str:
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+async def file_response(request: Request, meta: dict, storage) -> Response:
+    """Serve a stored file with ETag/Last-Modified validators, 304s and single byte ranges."""
+    if meta.get("missing"):
+        raise HTTPException(status_code=404, detail="File not found")
+
+    etag, size = meta["etag"], meta["size"]
+    headers = {
+        "ETag": etag,
+        "Last-Modified": meta["last_modified"],
+        "Cache-Control": CACHE_CONTROL,
+        "Accept-Ranges": "bytes"
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if _etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+    elif _not_modified_since(request.headers.get("if-modified-since"), meta["mtime"]):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and if_range and if_range != etag and if_range != meta["last_modified"]:
+        range_header = None  # Client's copy is stale: send the whole file
+
+    ranges = parse_range(range_header, size) if range_header else None
+    # Multi-range requests are answered with the full body, which the spec allows
+    if ranges is not None and len(ranges) == 1:
+        start, end = ranges[0]
+        if start >= size:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        length = end - start + 1
+        return StreamingResponse(
+            storage.read(meta["storage_key"], start, length),
+            status_code=206,
+            media_type=guess_type(meta["file_name"])[0] or "application/octet-stream",
+            headers={
+                **headers,
+                "Content-Range": f"bytes {start}-{end}/{size}",
+                "Content-Length": str(length),
+                "Content-Disposition": _content_disposition(meta["file_name"])
+            }
+        )
+    if ranges == [] and size:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+
+    # Files on local disk go out through FileResponse (sendfile); remote ones are streamed
+    path = await storage.local_path(meta["storage_key"])
+    if path is None:
+        return StreamingResponse(
+            storage.read(meta["storage_key"]),
+            media_type=guess_type(meta["file_name"])[0] or "application/octet-stream",
+            headers={
+                **headers,
+                "Content-Length": str(size),
+                "Content-Disposition": _content_disposition(meta["file_name"])
+            }
+        )
+    stat = os.stat_result((0, 0, 0, 0, 0, 0, size, 0, meta["mtime"], 0))
+    return FileResponse(path, headers=headers, filename=meta["file_name"], stat_result=stat)
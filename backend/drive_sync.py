@@ -0,0 +1,327 @@
+import asyncio
+import logging
+import os
+import random
+import shutil
+import uuid
+from datetime import datetime, timedelta, timezone
+from mimetypes import guess_type
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = int(os.getenv("DRIVE_CHUNK_SIZE", 8 * 1024 * 1024))  # must be a multiple of 256 KiB
+MAX_ATTEMPTS = int(os.getenv("DRIVE_MAX_ATTEMPTS", 8))
+BACKOFF_BASE = float(os.getenv("DRIVE_BACKOFF_BASE", 30))
+BACKOFF_MAX = float(os.getenv("DRIVE_BACKOFF_MAX", 3600))
+POLL_INTERVAL = 5.0
+
+Progress = Callable[[str, int], Awaitable[None]]
+
+
+class DriveNotConnected(Exception):
+    pass
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class GoogleDrive:
+    """Resumable uploads to the user's Drive with the stored OAuth credentials."""
+
+    def __init__(self, db, creds_doc: dict):
+        self.db = db
+        self.creds_doc = creds_doc
+
+    def _credentials(self):
+        from google.oauth2.credentials import Credentials
+
+        expiry = self.creds_doc.get("expiry")
+        creds = Credentials(
+            token=self.creds_doc.get("access_token"),
+            refresh_token=self.creds_doc.get("refresh_token"),
+            token_uri=self.creds_doc.get("token_uri"),
+            client_id=self.creds_doc.get("client_id"),
+            client_secret=self.creds_doc.get("client_secret"),
+            scopes=self.creds_doc.get("scopes")
+        )
+        if expiry:
+            # google-auth compares against a naive UTC datetime
+            creds.expiry = datetime.fromisoformat(expiry).astimezone(timezone.utc).replace(tzinfo=None)
+        return creds
+
+    async def _save_token(self, creds):
+        if creds.token == self.creds_doc.get("access_token"):
+            return
+        self.creds_doc["access_token"] = creds.token
+        await self.db.drive_credentials.update_one(
+            {"user_id": self.creds_doc["user_id"]},
+            {"$set": {
+                "access_token": creds.token,
+                "expiry": creds.expiry.replace(tzinfo=timezone.utc).isoformat() if creds.expiry else None,
+                "updated_at": _now().isoformat()
+            }}
+        )
+
+    async def upload(self, job: dict, on_progress: Progress) -> str:
+        from google.auth.transport.requests import Request as GoogleRequest
+        from googleapiclient.discovery import build
+        from googleapiclient.errors import HttpError
+        from googleapiclient.http import MediaFileUpload
+
+        creds = self._credentials()
+        if not creds.valid and creds.refresh_token:
+            await asyncio.to_thread(creds.refresh, GoogleRequest())
+        await self._save_token(creds)
+
+        service = await asyncio.to_thread(build, "drive", "v3", credentials=creds, cache_discovery=False)
+        media = MediaFileUpload(job["file_path"], mimetype=job["mime_type"], chunksize=CHUNK_SIZE, resumable=True)
+        body = {"name": job["file_name"]}
+        if os.getenv("DRIVE_FOLDER_ID"):
+            body["parents"] = [os.getenv("DRIVE_FOLDER_ID")]
+        request = service.files().create(body=body, media_body=media, fields="id")
+
+        response = None
+        try:
+            if job.get("resumable_uri"):
+                # Ask the session where it got to before sending more bytes
+                offset, file_id = await self._session_status(creds, job["resumable_uri"], media.size())
+                if file_id:
+                    return file_id
+                if offset is None:
+                    await on_progress(None, 0)
+                else:
+                    request.resumable_uri = job["resumable_uri"]
+                    request.resumable_progress = offset
+            while response is None:
+                status, response = await asyncio.to_thread(request.next_chunk)
+                if status:
+                    await on_progress(request.resumable_uri, status.resumable_progress)
+        except HttpError as e:
+            if e.resp.status in (404, 410):
+                # Upload session expired; the next attempt starts over
+                await on_progress(None, 0)
+            raise
+        finally:
+            media.stream().close()
+            await self._save_token(creds)
+        return response["id"]
+
+    async def _session_status(self, creds, resumable_uri: str, size: int) -> Tuple[Optional[int], Optional[str]]:
+        """(bytes the session holds, file id if it already completed); offset is None once it expired."""
+        from google.auth.transport.requests import AuthorizedSession
+
+        session = AuthorizedSession(creds)
+        try:
+            response = await asyncio.to_thread(
+                session.put, resumable_uri, headers={"Content-Range": f"bytes */{size}", "Content-Length": "0"}
+            )
+        finally:
+            session.close()
+        if response.status_code in (200, 201):
+            return size, response.json()["id"]
+        if response.status_code == 308:
+            # "Range: bytes=0-<last byte>", absent when nothing arrived yet
+            received = response.headers.get("Range")
+            return (int(received.rsplit("-", 1)[-1]) + 1 if received else 0), None
+        if response.status_code in (404, 410):
+            return None, None
+        raise ConnectionError(f"Drive upload session status returned {response.status_code}")
+
+
+class FakeDrive:
+    """Local-directory stand-in for Drive with the same resumable semantics.
+
+    Sessions are ``<root>/sessions/<id>.part`` files that grow chunk by
+    chunk; finished files move to ``<root>/files/<file id>``. Set
+    ``DRIVE_BACKEND=fake`` to use it.
+    """
+
+    def __init__(self, root: Path, chunk_size: int = CHUNK_SIZE, fail_after_chunks: Optional[int] = None):
+        self.root = Path(root)
+        self.chunk_size = chunk_size
+        self.fail_after_chunks = fail_after_chunks
+        (self.root / "sessions").mkdir(parents=True, exist_ok=True)
+        (self.root / "files").mkdir(parents=True, exist_ok=True)
+
+    async def upload(self, job: dict, on_progress: Progress) -> str:
+        session_id = job.get("resumable_uri") or uuid.uuid4().hex
+        part = self.root / "sessions" / f"{session_id}.part"
+        # Like a real session, trust what the server holds, not the client's counter
+        offset = part.stat().st_size if part.exists() else 0
+
+        sent = 0
+        with open(job["file_path"], "rb") as src, open(part, "ab") as out:
+            src.seek(offset)
+            while True:
+                data = await asyncio.to_thread(src.read, self.chunk_size)
+                if not data:
+                    break
+                if self.fail_after_chunks is not None and sent >= self.fail_after_chunks:
+                    raise ConnectionError("fake drive dropped the connection")
+                out.write(data)
+                out.flush()
+                offset += len(data)
+                sent += 1
+                await on_progress(session_id, offset)
+
+        file_id = uuid.uuid4().hex
+        shutil.move(str(part), str(self.root / "files" / file_id))
+        return file_id
+
+
+async def default_client(db, user_id: str):
+    if os.getenv("DRIVE_BACKEND", "google") == "fake":
+        return FakeDrive(Path(os.getenv("DRIVE_FAKE_ROOT", "fake_drive")))
+    creds_doc = await db.drive_credentials.find_one({"user_id": user_id}, {"_id": 0})
+    if not creds_doc:
+        raise DriveNotConnected("Google Drive is not connected")
+    return GoogleDrive(db, creds_doc)
+
+
+class DriveSyncWorker:
+    """Mongo-backed queue that mirrors documents to their uploader's Drive.
+
+    Jobs live in ``drive_jobs`` keyed by document id. The resumable session
+    and byte offset are saved after every chunk, so a restart continues the
+    same upload. Failed attempts are retried with jittered exponential
+    backoff, and each worker runs at most ``per_user`` uploads per user.
+    """
+
+    def __init__(self, db, storage, client_factory=default_client, workers: int = None, per_user: int = None):
+        self.db = db
+        self.storage = storage
+        self.client_factory = client_factory
+        self.workers = workers or int(os.getenv("DRIVE_SYNC_WORKERS", 4))
+        self.per_user = per_user or int(os.getenv("DRIVE_SYNC_PER_USER", 2))
+        self._active: Dict[str, int] = {}
+        self._tasks = []
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+
+    async def start(self):
+        await self.db.drive_jobs.update_many(
+            {"status": "running"},
+            {"$set": {"status": "pending", "updated_at": _now()}}
+        )
+        self._stopping = False
+        self._tasks = [asyncio.create_task(self._consume()) for _ in range(self.workers)]
+        logger.info(f"Drive sync started with {self.workers} workers")
+
+    async def stop(self):
+        self._stopping = True
+        self._wakeup.set()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def enqueue(self, doc: dict, user_id: str):
+        now = _now()
+        await self.db.drive_jobs.update_one(
+            {"doc_id": doc["id"]},
+            {"$set": {
+                "doc_id": doc["id"],
+                "user_id": user_id,
+                "storage_key": doc["storage_key"],
+                "file_name": doc["file_name"],
+                "mime_type": guess_type(doc["file_name"])[0] or "application/octet-stream",
+                "size": doc.get("file_size", 0),
+                "status": "pending",
+                "attempts": 0,
+                "next_attempt_at": now,
+                "resumable_uri": None,
+                "progress": 0,
+                "error": None,
+                "created_at": now,
+                "updated_at": now
+            }},
+            upsert=True
+        )
+        await self.db.documents.update_one({"id": doc["id"]}, {"$set": {"drive_status": "pending"}})
+        self._wakeup.set()
+
+    async def _claim(self):
+        busy = [user_id for user_id, n in self._active.items() if n >= self.per_user]
+        now = _now()
+        return await self.db.drive_jobs.find_one_and_update(
+            {"status": "pending", "next_attempt_at": {"$lte": now}, "user_id": {"$nin": busy}},
+            {"$set": {"status": "running", "updated_at": now}, "$inc": {"attempts": 1}},
+            sort=[("next_attempt_at", 1)],
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _consume(self):
+        while not self._stopping:
+            try:
+                job = await self._claim()
+            except Exception as e:
+                logger.error(f"Drive sync queue unavailable: {e}")
+                job = None
+
+            if not job:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            user_id = job["user_id"]
+            self._active[user_id] = self._active.get(user_id, 0) + 1
+            try:
+                await self._process(job)
+            finally:
+                self._active[user_id] -= 1
+                if not self._active[user_id]:
+                    del self._active[user_id]
+                self._wakeup.set()
+
+    async def _process(self, job: dict):
+        doc_id = job["doc_id"]
+        await self.db.documents.update_one({"id": doc_id}, {"$set": {"drive_status": "running"}})
+
+        async def on_progress(resumable_uri: Optional[str], progress: int):
+            await self.db.drive_jobs.update_one(
+                {"doc_id": doc_id},
+                {"$set": {"resumable_uri": resumable_uri, "progress": progress, "updated_at": _now()}}
+            )
+
+        try:
+            client = await self.client_factory(self.db, job["user_id"])
+            async with self.storage.local_copy(job["storage_key"]) as path:
+                file_id = await client.upload({**job, "file_path": str(path)}, on_progress)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            retry = not isinstance(e, DriveNotConnected) and job["attempts"] < MAX_ATTEMPTS
+            delay = min(BACKOFF_BASE * (2 ** (job["attempts"] - 1)), BACKOFF_MAX)
+            delay += random.uniform(0, delay / 2)
+            status = "pending" if retry else "failed"
+            logger.warning(f"Drive upload of document {doc_id} failed ({status}): {e}")
+            await self.db.drive_jobs.update_one(
+                {"doc_id": doc_id},
+                {"$set": {
+                    "status": status,
+                    "error": str(e),
+                    "next_attempt_at": _now() + timedelta(seconds=delay),
+                    "updated_at": _now()
+                }}
+            )
+            await self.db.documents.update_one({"id": doc_id}, {"$set": {"drive_status": status}})
+            return
+
+        await self.db.drive_jobs.update_one(
+            {"doc_id": doc_id},
+            {"$set": {"status": "done", "drive_file_id": file_id, "progress": job.get("size", 0),
+                      "resumable_uri": None, "error": None, "updated_at": _now()}}
+        )
+        await self.db.documents.update_one(
+            {"id": doc_id}, {"$set": {"gdrive_file_id": file_id, "drive_status": "synced"}}
+        )
+        logger.info(f"Document {doc_id} mirrored to Drive as {file_id}")
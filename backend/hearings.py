@@ -0,0 +1,105 @@
+import os
+import re
+from datetime import datetime, time, timedelta, timezone
+from typing import Optional
+from zoneinfo import ZoneInfo
+
+from pymongo import UpdateOne
+
+# Hearing dates and times are entered in the courts' local time
+SESSION_TZ = ZoneInfo(os.getenv("SESSION_TIMEZONE", "Asia/Dubai"))
+BATCH_SIZE = 1000
+
+_DIGITS = str.maketrans("٠١٢٣٤٥٦٧٨٩", "0123456789")
+_TIME_RE = re.compile(r"^(\d{1,2})[:.](\d{2})(?::(\d{2}))?\s*(am|pm|ص|م)?$", re.IGNORECASE)
+_DATE_FORMATS = ("%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y", "%Y/%m/%d")
+
+
+def _utc(value: datetime) -> str:
+    return value.astimezone(timezone.utc).replace(microsecond=0).isoformat()
+
+
+def parse_date(value: str):
+    value = (value or "").translate(_DIGITS).strip()
+    if "T" in value:
+        value = value.split("T", 1)[0]
+    for fmt in _DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def parse_time(value: str) -> Optional[time]:
+    value = (value or "").translate(_DIGITS).strip()
+    if not value:
+        return time(0, 0)
+    match = _TIME_RE.match(value)
+    if not match:
+        return None
+    hour, minute, second, meridiem = match.groups()
+    hour = int(hour)
+    if meridiem:
+        afternoon = meridiem.lower() in ("pm", "م")
+        hour = hour % 12 + (12 if afternoon else 0)
+    try:
+        return time(hour, int(minute), int(second or 0))
+    except ValueError:
+        return None
+
+
+def session_at(session_date: str, session_time: str = "") -> Optional[str]:
+    """UTC ISO timestamp for a hearing's local date and time, or None if unparseable.
+
+    Every value has the same fixed format, so string order is time order and
+    range queries on the field use its index.
+    """
+    day = parse_date(session_date)
+    at = parse_time(session_time)
+    if day is None or at is None:
+        return None
+    return _utc(datetime.combine(day, at, tzinfo=SESSION_TZ))
+
+
+def day_bounds(start: str, end: str):
+    """[start day 00:00, end day + 1 00:00) in local time, as UTC strings; full ISO timestamps pass through."""
+    def bound(value: str, next_day: bool) -> str:
+        if "T" in value:
+            parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+            return _utc(parsed if parsed.tzinfo else parsed.replace(tzinfo=SESSION_TZ))
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(f"Invalid date: {value}")
+        if next_day:
+            day += timedelta(days=1)
+        return _utc(datetime.combine(day, time(0, 0), tzinfo=SESSION_TZ))
+
+    return bound(start, False), bound(end, True)
+
+
+async def backfill_sessions(db) -> int:
+    """Fill session_at and the owning case's company_id/user_id on existing sessions."""
+    owners = {}
+    ops = []
+    updated = 0
+    async for session in db.sessions.find({}, {"_id": 0, "id": 1, "case_id": 1, "session_date": 1, "session_time": 1}):
+        case_id = session.get("case_id")
+        if case_id not in owners:
+            owners[case_id] = await db.cases.find_one(
+                {"id": case_id}, {"_id": 0, "company_id": 1, "user_id": 1}
+            ) or {}
+        owner = owners[case_id]
+        ops.append(UpdateOne({"id": session["id"]}, {"$set": {
+            "session_at": session_at(session.get("session_date", ""), session.get("session_time", "")),
+            "company_id": owner.get("company_id", ""),
+            "user_id": owner.get("user_id", "")
+        }}))
+        if len(ops) >= BATCH_SIZE:
+            await db.sessions.bulk_write(ops, ordered=False)
+            updated += len(ops)
+            ops = []
+    if ops:
+        await db.sessions.bulk_write(ops, ordered=False)
+        updated += len(ops)
+    return updated
@@ -0,0 +1,251 @@
+import argparse
+import asyncio
+import logging
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import httpx
+
+from db_indexes import check_query_plans, ensure_indexes
+from hearings import backfill_sessions
+from pymongo import UpdateOne
+
+from passwords import PASSWORD_ROUNDS, HASH_WORKERS, hash_password
+from server import UPLOAD_DIR, User, app, company_stats, db, search_index, storage
+from storage import TieredStorage, blob_key, unmigrated_collections
+from tenant_export import restore_export
+
+
+BATCH_SIZE = 1000
+
+logger = logging.getLogger("manage")
+
+
+async def reindex_search(args):
+    count = 0
+    async for doc in db.documents.find({"ocr_status": "done"}, {"_id": 0}):
+        await search_index.index_document(doc)
+        count += 1
+    logger.info(f"Indexed {count} documents")
+
+
+async def reconcile_balances(args):
+    totals = {
+        row["_id"]: row["paid"]
+        async for row in db.payments.aggregate([
+            {"$group": {"_id": "$invoice_id", "paid": {"$sum": "$amount"}}}
+        ])
+    }
+
+    repaired = 0
+    ops = []
+    async for invoice in db.invoices.find({}, {"_id": 0, "id": 1, "total_amount": 1, "amount_paid": 1, "balance_due": 1, "status": 1}):
+        amount_paid = totals.get(invoice["id"], 0.0)
+        balance_due = invoice["total_amount"] - amount_paid
+        update = {"amount_paid": amount_paid, "balance_due": balance_due}
+        if amount_paid >= invoice["total_amount"]:
+            update["status"] = "paid"
+        elif amount_paid > 0:
+            update["status"] = "partial"
+        elif invoice.get("status") in ("paid", "partial"):
+            update["status"] = "pending"
+
+        if any(invoice.get(k) != v for k, v in update.items()):
+            ops.append(UpdateOne({"id": invoice["id"]}, {"$set": update}))
+            repaired += 1
+        if len(ops) >= BATCH_SIZE:
+            await db.invoices.bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        await db.invoices.bulk_write(ops, ordered=False)
+    logger.info(f"Repaired balances on {repaired} invoices")
+
+
+async def backfill_invoices(args):
+    # Invoices made before company scoping have no company_id; take it from their case
+    owners = {}
+    ops = []
+    updated = 0
+    async for invoice in db.invoices.find({"company_id": {"$in": [None, ""]}}, {"_id": 0, "id": 1, "case_id": 1}):
+        case_id = invoice.get("case_id")
+        if case_id not in owners:
+            case = await db.cases.find_one({"id": case_id}, {"_id": 0, "company_id": 1})
+            owners[case_id] = (case or {}).get("company_id")
+        if not owners[case_id]:
+            continue
+        ops.append(UpdateOne({"id": invoice["id"]}, {"$set": {"company_id": owners[case_id]}}))
+        updated += 1
+        if len(ops) >= BATCH_SIZE:
+            await db.invoices.bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        await db.invoices.bulk_write(ops, ordered=False)
+    logger.info(f"Set company_id on {updated} invoices")
+
+
+async def rebuild_stats(args):
+    company_ids = await db.companies.distinct("id")
+    for company_id in company_ids:
+        await company_stats.rebuild(company_id)
+    logger.info(f"Rebuilt stats for {len(company_ids)} companies")
+
+
+async def backfill_session_times(args):
+    updated = await backfill_sessions(db)
+    logger.info(f"Normalized {updated} sessions")
+
+
+async def restore(args):
+    counts = await restore_export(db, Path(args.archive), storage, search_index, company_stats)
+    logger.info(f"Restore finished: {counts}")
+
+
+async def migrate_storage_keys(args):
+    # Absolute upload paths become keys relative to the upload directory
+    root = UPLOAD_DIR.resolve()
+    targets = [
+        ("documents", "id", "file_path", "storage_key"),
+        ("blobs", "sha256", "path", "key"),
+        ("ocr_jobs", "sha256", "file_path", "storage_key"),
+        ("drive_jobs", "doc_id", "file_path", "storage_key"),
+    ]
+    for collection, id_field, old, new in targets:
+        migrated = 0
+        skipped = 0
+        ops = []
+        async for doc in db[collection].find({old: {"$exists": True}}, {"_id": 0, id_field: 1, old: 1}):
+            path = Path(doc[old]).resolve()
+            if not path.is_relative_to(root):
+                skipped += 1
+                logger.warning(f"{collection} {doc[id_field]}: {path} is outside {root}")
+                continue
+            ops.append(UpdateOne(
+                {id_field: doc[id_field]},
+                {"$set": {new: path.relative_to(root).as_posix()}, "$unset": {old: ""}}
+            ))
+            migrated += 1
+            if len(ops) >= BATCH_SIZE:
+                await db[collection].bulk_write(ops, ordered=False)
+                ops = []
+        if ops:
+            await db[collection].bulk_write(ops, ordered=False)
+        logger.info(f"Migrated {migrated} {collection} to storage keys, skipped {skipped}")
+    remaining = await unmigrated_collections(db)
+    if remaining:
+        logger.error(f"Skipped paths in {', '.join(remaining)} need fixing by hand; the API will not start until they are gone")
+        sys.exit(1)
+
+
+async def demote_storage(args):
+    if not isinstance(storage, TieredStorage):
+        logger.error("demote-storage needs STORAGE_BACKEND=tiered")
+        sys.exit(1)
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=args.older_than)).isoformat()
+    demoted = 0
+    async for blob in db.blobs.find({"created_at": {"$lt": cutoff}}, {"_id": 0, "sha256": 1, "key": 1}):
+        if await storage.demote(blob.get("key") or blob_key(blob["sha256"])):
+            demoted += 1
+    logger.info(f"Moved {demoted} blobs older than {args.older_than} days to cold storage")
+
+
+async def create_indexes(args):
+    failed = await ensure_indexes(db)
+    if failed:
+        logger.error(f"Index builds failed on {', '.join(failed)}; remove the duplicate records and retry")
+        sys.exit(1)
+
+
+async def check_indexes(args):
+    failed = await ensure_indexes(db)
+    if failed:
+        logger.error(f"Index builds failed on {', '.join(failed)}; remove the duplicate records and retry")
+        sys.exit(1)
+    failures = await check_query_plans(db)
+    if failures:
+        logger.error(f"{len(failures)} query shapes fall back to COLLSCAN: {', '.join(failures)}")
+        sys.exit(1)
+    logger.info("All query shapes use an index")
+
+
+async def bench_login(args):
+    # Logs a throwaway user in through the API, in process, while measuring event loop stalls
+    email = f"bench-{uuid.uuid4().hex[:8]}@example.com"
+    password = "bench-password"
+    user = User(email=email, password_hash=await hash_password(password), full_name_ar="bench")
+    await db.users.insert_one(user.model_dump())
+
+    latencies = []
+    lag = []
+    done = asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lag.append(time.perf_counter() - start - 0.01)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def one():
+            async with semaphore:
+                start = time.perf_counter()
+                r = await client.post("/api/auth/login", json={"email": email, "password": password})
+                r.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+
+        tick = asyncio.create_task(ticker())
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*[one() for _ in range(args.requests)])
+        finally:
+            elapsed = time.perf_counter() - started
+            done.set()
+            await tick
+            await db.users.delete_one({"email": email})
+
+    pct = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    logger.info(
+        f"{args.requests} logins, concurrency {args.concurrency}, rounds {PASSWORD_ROUNDS}, "
+        f"hash workers {HASH_WORKERS}: {args.requests / elapsed:.1f}/s, "
+        f"p50 {pct[49] * 1000:.0f} ms, p99 {pct[98] * 1000:.0f} ms, "
+        f"max event loop stall {max(lag, default=0) * 1000:.0f} ms"
+    )
+
+
+COMMANDS = {
+    "reindex-search": (reindex_search, "Rebuild the document search index from OCR text"),
+    "reconcile-balances": (reconcile_balances, "Recompute invoice paid/balance totals from payments"),
+    "backfill-invoices": (backfill_invoices, "Set company_id on invoices from their case (run before rebuild-stats)"),
+    "rebuild-stats": (rebuild_stats, "Recompute materialized per-company dashboard stats"),
+    "backfill-sessions": (backfill_session_times, "Fill session_at and case owner fields on existing sessions"),
+    "restore-export": (restore, "Load a company export archive into this database"),
+    "migrate-storage-keys": (migrate_storage_keys, "Replace stored upload paths with storage keys"),
+    "demote-storage": (demote_storage, "Move old blobs from the hot to the cold storage tier"),
+    "ensure-indexes": (create_indexes, "Create all registered Mongo indexes"),
+    "check-indexes": (check_indexes, "Fail if any endpoint query shape does a COLLSCAN"),
+    "bench-login": (bench_login, "Measure login latency under concurrent logins"),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LegalCore maintenance commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name, (_, help_text) in COMMANDS.items():
+        subparsers.add_parser(name, help=help_text)
+    subparsers.choices["restore-export"].add_argument("archive", help="Path to the export .zip")
+    subparsers.choices["demote-storage"].add_argument("--older-than", type=int, default=90, help="Age in days")
+    subparsers.choices["bench-login"].add_argument("--concurrency", type=int, default=20)
+    subparsers.choices["bench-login"].add_argument("--requests", type=int, default=200)
+
+    args = parser.parse_args()
+    handler, _ = COMMANDS[args.command]
+    asyncio.run(handler(args))
+
+
+if __name__ == "__main__":
+    main()
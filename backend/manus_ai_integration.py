@@ -1,6 +1,98 @@
 import asyncio
 import os
-from openai import OpenAI
+import random
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict
+
+import httpx
+from openai import (
+    AsyncOpenAI,
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+    RateLimitError,
+)
+
+REQUEST_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 120))
+CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", 10))
+MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 3))
+BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", 0.5))
+BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", 8))
+MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", 20))
+CLIENT_CACHE_SIZE = int(os.getenv("LLM_CLIENT_CACHE_SIZE", 32))
+
+SUMMARY_PROMPT = (
+    "لخّص المحادثة التالية بين محامٍ ومساعد قانوني في فقرات موجزة، مع الإبقاء على "
+    "الوقائع وأرقام القضايا والمواد القانونية والتواريخ والأسئلة المفتوحة. "
+    "ادمج الملخص السابق إن وجد."
+)
+
+RETRYABLE_ERRORS = (APIConnectionError, APITimeoutError, RateLimitError, InternalServerError)
+
+# One pooled client per API key, least recently used evicted first. An evicted
+# client may still be serving requests, so it is closed when the last of them
+# finishes; _in_use counts the requests holding each client.
+_clients: "OrderedDict[str, AsyncOpenAI]" = OrderedDict()
+_in_use: Dict[AsyncOpenAI, int] = {}
+_evicted = set()
+
+
+def _get_client(api_key):
+    client = _clients.get(api_key)
+    if client is not None:
+        _clients.move_to_end(api_key)
+        return client
+
+    http_client = httpx.AsyncClient(
+        timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT),
+        limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS)
+    )
+    client = AsyncOpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+    _clients[api_key] = client
+    while len(_clients) > CLIENT_CACHE_SIZE:
+        _, evicted = _clients.popitem(last=False)
+        _evicted.add(evicted)
+    return client
+
+
+@asynccontextmanager
+async def using_client(api_key):
+    client = _get_client(api_key)
+    _in_use[client] = _in_use.get(client, 0) + 1
+    try:
+        # Close evicted clients nobody is using, including any this call pushed out
+        for idle in [c for c in _evicted if c not in _in_use]:
+            _evicted.discard(idle)
+            await idle.close()
+        yield client
+    finally:
+        _in_use[client] -= 1
+        if not _in_use[client]:
+            del _in_use[client]
+            if client in _evicted:
+                _evicted.discard(client)
+                await client.close()
+
+
+async def close_clients():
+    while _clients:
+        _, client = _clients.popitem()
+        await client.close()
+    while _evicted:
+        await _evicted.pop().close()
+
+
+async def with_retries(call):
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return await call()
+        except RETRYABLE_ERRORS:
+            if attempt == MAX_RETRIES:
+                raise
+            delay = min(BACKOFF_BASE * (2 ** attempt), BACKOFF_MAX)
+            await asyncio.sleep(delay + random.uniform(0, delay / 2))
+
 
 class UserMessage:
     def __init__(self, text):
@@ -13,36 +105,74 @@ class LlmChat:
         self.system_message = system_message
         self.model_provider = "openai"
         self.model_name = "gpt-4.1-mini"
-        
-        # Initialize OpenAI client if key is available
-        self.client = None
-        if self.api_key and self.api_key != "your_manus_ai_key_here":
-            try:
-                self.client = OpenAI(api_key=self.api_key)
-            except Exception:
-                self.client = None
+        self.has_key = bool(self.api_key and self.api_key != "your_manus_ai_key_here")
+        self.history = []
 
     def with_model(self, provider, model):
         self.model_provider = provider
         self.model_name = model
         return self
 
+    def with_history(self, messages):
+        self.history = list(messages)
+        return self
+
+    def _messages(self, message):
+        messages = []
+        if self.system_message:
+            messages.append({"role": "system", "content": self.system_message})
+        messages.extend(self.history)
+        messages.append({"role": "user", "content": message.text})
+        return messages
+
+    def _model(self):
+        return self.model_name if self.model_provider == "openai" else "gpt-4.1-mini"
+
+    def _mock_reply(self, message):
+        return f"مرحباً! أنا مساعد Manus الذكي. لقد استلمت رسالتك: '{message.text}'. حالياً أعمل في وضع المعاينة، وعند ربط مفتاح API سأتمكن من تقديم تحليل قانوني كامل."
+
     async def send_message(self, message):
-        if self.client:
-            try:
-                messages = []
-                if self.system_message:
-                    messages.append({"role": "system", "content": self.system_message})
-                messages.append({"role": "user", "content": message.text})
-                
-                response = self.client.chat.completions.create(
-                    model=self.model_name if self.model_provider == "openai" else "gpt-4.1-mini",
-                    messages=messages
-                )
-                return response.choices[0].message.content
-            except Exception as e:
-                return f"Manus AI Error: {str(e)}"
-        
+        if self.has_key:
+            async with using_client(self.api_key) as client:
+                response = await with_retries(lambda: client.chat.completions.create(
+                    model=self._model(),
+                    messages=self._messages(message)
+                ))
+            return response.choices[0].message.content
+
         # Fallback to smart mock if no API key
         await asyncio.sleep(1) # Simulate thinking
-        return f"مرحباً! أنا مساعد Manus الذكي. لقد استلمت رسالتك: '{message.text}'. حالياً أعمل في وضع المعاينة، وعند ربط مفتاح API سأتمكن من تقديم تحليل قانوني كامل."
+        return self._mock_reply(message)
+
+    async def summarize(self, summary, messages):
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+        if summary:
+            transcript = f"الملخص السابق:\n{summary}\n\n{transcript}"
+        async with using_client(self.api_key) as client:
+            response = await with_retries(lambda: client.chat.completions.create(
+                model=self._model(),
+                messages=[{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": transcript}]
+            ))
+        return response.choices[0].message.content
+
+    async def stream_message(self, message):
+        # Yields text deltas; only opening the stream is retried, since
+        # tokens already sent to the caller cannot be taken back.
+        if self.has_key:
+            async with using_client(self.api_key) as client:
+                stream = await with_retries(lambda: client.chat.completions.create(
+                    model=self._model(),
+                    messages=self._messages(message),
+                    stream=True
+                ))
+                try:
+                    async for chunk in stream:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            yield chunk.choices[0].delta.content
+                finally:
+                    await stream.close()
+            return
+
+        for word in self._mock_reply(message).split(" "):
+            await asyncio.sleep(0.05)
+            yield word + " "
@@ -0,0 +1,293 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import List, Tuple
+
+import pytesseract
+from PIL import Image
+from pdf2image import convert_from_path, pdfinfo_from_path
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+OCR_EXTENSIONS = [".pdf", ".png", ".jpg", ".jpeg"]
+OCR_LANG = "ara+eng"
+PAGE_BATCH = int(os.getenv("OCR_PAGE_BATCH", 4))
+MAX_ATTEMPTS = 3
+# Jobs that were running when a worker process died are retried without
+# using an attempt, up to this many times in case they are what kills it
+MAX_CRASHES = 5
+BACKOFF_BASE = float(os.getenv("OCR_BACKOFF_BASE", 30))
+BACKOFF_MAX = float(os.getenv("OCR_BACKOFF_MAX", 1800))
+# A text layer only stands in for OCR when it has at least this many non-space
+# characters, and at least TEXT_LAYER_RATIO of the document's typical text page.
+# Scans often carry a short e-filing stamp or header in a text layer; both
+# thresholds keep such pages going to OCR.
+TEXT_LAYER_MIN_CHARS = int(os.getenv("OCR_TEXT_LAYER_MIN_CHARS", 200))
+TEXT_LAYER_RATIO = float(os.getenv("OCR_TEXT_LAYER_RATIO", 0.3))
+TEXT_LAYER_TIMEOUT = 120
+POLL_INTERVAL = 5.0
+
+
+def _ocr_image(path) -> str:
+    with Image.open(path) as img:
+        return pytesseract.image_to_string(img, lang=OCR_LANG)
+
+
+def _text_layer(file_path: str, page_count: int) -> List[str]:
+    """Embedded text per page via poppler's pdftotext; empty strings if it can't be read."""
+    try:
+        result = subprocess.run(
+            ["pdftotext", "-enc", "UTF-8", file_path, "-"],
+            capture_output=True, check=True, timeout=TEXT_LAYER_TIMEOUT
+        )
+    except (OSError, subprocess.SubprocessError):
+        return [""] * page_count
+    # pdftotext ends every page with a form feed
+    pages = result.stdout.decode("utf-8", "replace").split("\f")[:page_count]
+    return pages + [""] * (page_count - len(pages))
+
+
+def _text_pages(texts: List[str]) -> List[bool]:
+    """Which pages' text layers are complete enough to skip OCR."""
+    counts = [len("".join(text.split())) for text in texts]
+    candidates = sorted(n for n in counts if n >= TEXT_LAYER_MIN_CHARS)
+    if not candidates:
+        return [False] * len(counts)
+    typical = candidates[len(candidates) // 2]
+    floor = max(TEXT_LAYER_MIN_CHARS, TEXT_LAYER_RATIO * typical)
+    return [n >= floor for n in counts]
+
+
+def _scanned_runs(pages: list) -> List[Tuple[int, int]]:
+    """(first, last) page numbers covering the pages still missing text."""
+    runs = []
+    for number, page in enumerate(pages, start=1):
+        if page is not None:
+            continue
+        if runs and runs[-1][1] == number - 1 and number - runs[-1][0] < PAGE_BATCH:
+            runs[-1] = (runs[-1][0], number)
+        else:
+            runs.append((number, number))
+    return runs
+
+
+def run_ocr(file_path: str, file_ext: str) -> List[Tuple[str, str]]:
+    """(text, method) per page, where method is "text" for an embedded text layer or "ocr"."""
+    # Runs inside a worker process; must stay importable without the app.
+    if file_ext.lower() != ".pdf":
+        return [(_ocr_image(file_path), "ocr")]
+
+    page_count = pdfinfo_from_path(file_path)["Pages"]
+    texts = _text_layer(file_path, page_count)
+    pages = [(text, "text") if ok else None for text, ok in zip(texts, _text_pages(texts))]
+
+    # Rasterize only image-only pages, as runs of at most PAGE_BATCH
+    # consecutive pages so memory stays flat regardless of document length.
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for first_page, last_page in _scanned_runs(pages):
+            image_paths = convert_from_path(
+                file_path,
+                first_page=first_page,
+                last_page=last_page,
+                output_folder=temp_dir,
+                paths_only=True
+            )
+            for image_path in image_paths:
+                # pdf2image names each image <prefix>-<page>.ppm; a page that
+                # failed to rasterize has no file, so match by that number
+                number = int(Path(image_path).stem.rsplit("-", 1)[-1])
+                pages[number - 1] = (_ocr_image(image_path), "ocr")
+                os.remove(image_path)
+    # A page poppler could not rasterize is stored empty rather than dropped
+    return [page or ("", "ocr") for page in pages]
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _retry_at(retries: int) -> str:
+    delay = min(BACKOFF_BASE * (2 ** max(retries - 1, 0)), BACKOFF_MAX)
+    delay += random.uniform(0, delay / 2)
+    return (datetime.now(timezone.utc) + timedelta(seconds=delay)).isoformat()
+
+
+class OCRWorkerPool:
+    """Mongo-backed OCR job queue drained by a process pool.
+
+    Jobs live in ``ocr_jobs`` so pending work survives a restart; jobs left
+    ``running`` by a dead process are put back to ``pending`` on start.
+    Failed runs are retried after ``not_before`` with jittered backoff, and a
+    pool broken by a dying worker process is replaced.
+    Jobs are keyed by blob hash, and results are written to the blob and to
+    every document that references it.
+    """
+
+    def __init__(self, db, storage, workers: int = None, on_done=None):
+        self.db = db
+        self.storage = storage
+        self.on_done = on_done
+        self.workers = workers or int(os.getenv("OCR_WORKERS", 0)) or os.cpu_count() or 1
+        self._executor = None
+        self._tasks = []
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+
+    async def start(self):
+        await self.db.ocr_jobs.update_many(
+            {"status": "running"},
+            {"$set": {"status": "pending", "updated_at": _now()}}
+        )
+        self._executor = self._new_executor()
+        self._stopping = False
+        self._tasks = [asyncio.create_task(self._consume()) for _ in range(self.workers)]
+        logger.info(f"OCR worker pool started with {self.workers} workers")
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def _replace_executor(self, broken: ProcessPoolExecutor):
+        # Every job that was in the dead pool lands here; only the first replaces it
+        if self._executor is not broken or self._stopping:
+            return
+        logger.error("OCR worker process died; starting a new pool")
+        broken.shutdown(wait=False, cancel_futures=True)
+        self._executor = self._new_executor()
+
+    async def stop(self):
+        self._stopping = True
+        self._wakeup.set()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def enqueue(self, sha256: str, storage_key: str, file_ext: str):
+        now = _now()
+        await self.db.ocr_jobs.update_one(
+            {"sha256": sha256},
+            {"$set": {
+                "sha256": sha256,
+                "storage_key": storage_key,
+                "file_ext": file_ext,
+                "status": "pending",
+                "attempts": 0,
+                "crashes": 0,
+                "not_before": None,
+                "error": None,
+                "created_at": now,
+                "updated_at": now,
+                "started_at": None,
+                "finished_at": None
+            }},
+            upsert=True
+        )
+        await self._set_status(sha256, "pending")
+        self._wakeup.set()
+
+    async def _set_status(self, sha256: str, status: str, pages: List[Tuple[str, str]] = None):
+        update = {"ocr_status": status}
+        if pages is not None:
+            update["ocr_text"] = "\n".join(text for text, _ in pages)
+            update["page_count"] = len(pages)
+        await self.db.blobs.update_one({"sha256": sha256}, {"$set": update})
+        await self.db.documents.update_many({"sha256": sha256}, {"$set": update})
+
+    async def _claim(self):
+        return await self.db.ocr_jobs.find_one_and_update(
+            {"status": "pending", "$or": [{"not_before": None}, {"not_before": {"$lte": _now()}}]},
+            {"$set": {"status": "running", "started_at": _now(), "updated_at": _now()},
+             "$inc": {"attempts": 1}},
+            sort=[("created_at", 1)],
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _consume(self):
+        while not self._stopping:
+            try:
+                job = await self._claim()
+            except Exception as e:
+                logger.error(f"OCR queue unavailable: {e}")
+                job = None
+
+            if not job:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._process(job)
+
+    async def _process(self, job: dict):
+        sha256 = job["sha256"]
+        await self._set_status(sha256, "running")
+
+        loop = asyncio.get_running_loop()
+        executor = self._executor
+        try:
+            async with self.storage.local_copy(job["storage_key"]) as path:
+                pages = await loop.run_in_executor(
+                    executor, run_ocr, str(path), job["file_ext"]
+                )
+        except asyncio.CancelledError:
+            raise
+        except BrokenProcessPool as e:
+            self._replace_executor(executor)
+            crashes = job.get("crashes", 0) + 1
+            status = "failed" if crashes > MAX_CRASHES else "pending"
+            await self.db.ocr_jobs.update_one(
+                {"sha256": sha256},
+                {"$set": {"status": status, "crashes": crashes, "error": f"worker process died: {e}",
+                          "not_before": _retry_at(crashes), "updated_at": _now()},
+                 "$inc": {"attempts": -1}}
+            )
+            await self._set_status(sha256, status)
+            return
+        except Exception as e:
+            logger.warning(f"OCR failed for blob {sha256}: {e}")
+            status = "failed" if job["attempts"] >= MAX_ATTEMPTS else "pending"
+            await self.db.ocr_jobs.update_one(
+                {"sha256": sha256},
+                {"$set": {"status": status, "error": str(e), "not_before": _retry_at(job["attempts"]),
+                          "updated_at": _now()}}
+            )
+            await self._set_status(sha256, status)
+            return
+
+        await self.db.document_pages.delete_many({"sha256": sha256})
+        if pages:
+            await self.db.document_pages.insert_many([
+                {"sha256": sha256, "page": number, "text": text, "method": method}
+                for number, (text, method) in enumerate(pages, start=1)
+            ])
+        await self._set_status(sha256, "done", pages)
+        methods = {"text": 0, "ocr": 0}
+        for _, method in pages:
+            methods[method] += 1
+        await self.db.ocr_jobs.update_one(
+            {"sha256": sha256},
+            {"$set": {"status": "done", "error": None, "methods": methods, "finished_at": _now(), "updated_at": _now()}}
+        )
+        if self.on_done:
+            try:
+                await self.on_done(sha256)
+            except Exception as e:
+                logger.error(f"OCR completion hook failed for blob {sha256}: {e}")
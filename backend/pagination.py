@@ -0,0 +1,86 @@
+import base64
+import json
+from typing import List, Optional, Type, Union
+
+from fastapi import HTTPException, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+# Also the default: clients that never follow the cursor get the same 1000 rows as before
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(sort_field: str, value, last_id: str) -> str:
+    raw = json.dumps([sort_field, value, last_id], ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor: str, sort_field: str):
+    try:
+        field, value, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if field != sort_field:
+        raise HTTPException(status_code=400, detail="Cursor does not match sort order")
+    return value, last_id
+
+
+def parse_fields(fields: Optional[str], model: Type[BaseModel], sort_field: str) -> dict:
+    projection = {"_id": 0}
+    if not fields:
+        return projection
+    requested = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = [f for f in requested if f not in model.model_fields]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    # id and the sort key are always returned; the next cursor is built from them
+    for field in ["id", sort_field, *requested]:
+        projection[field] = 1
+    return projection
+
+
+async def paginate(
+    collection,
+    query: dict,
+    model: Type[BaseModel],
+    response: Response,
+    sort: str,
+    limit: int,
+    after: Optional[str] = None,
+    fields: Optional[str] = None
+) -> Union[List[BaseModel], JSONResponse]:
+    """Keyset-paginate ``collection`` on (sort field, id).
+
+    ``sort`` is a model field name, prefixed with ``-`` for descending order.
+    Full rows come back as ``model`` instances so legacy documents get the
+    model's defaults. A ``fields`` projection is returned as-is in a
+    JSONResponse, since partial rows would fail the route's response_model.
+    The cursor for the next page is sent in the ``X-Next-Cursor`` header
+    when more rows may follow.
+    """
+    descending = sort.startswith("-")
+    sort_field = sort.lstrip("-")
+    if sort_field not in model.model_fields:
+        raise HTTPException(status_code=400, detail=f"Cannot sort by {sort_field}")
+    direction = -1 if descending else 1
+
+    if after:
+        value, last_id = decode_cursor(after, sort_field)
+        op = "$lt" if descending else "$gt"
+        query = {"$and": [query, {"$or": [
+            {sort_field: {op: value}},
+            {sort_field: value, "id": {op: last_id}}
+        ]}]}
+
+    cursor = collection.find(query, parse_fields(fields, model, sort_field))
+    cursor = cursor.sort([(sort_field, direction), ("id", direction)]).limit(limit)
+    rows = await cursor.to_list(limit)
+
+    if len(rows) == limit:
+        last = rows[-1]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(sort_field, last.get(sort_field), last["id"])
+    if fields:
+        return JSONResponse(jsonable_encoder(rows), headers=dict(response.headers))
+    return [model(**row) for row in rows]
@@ -0,0 +1,73 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+
+from passlib.context import CryptContext
+
+# 535000 is passlib's sha256_crypt default, the cost existing hashes were made with
+PASSWORD_ROUNDS = int(os.getenv("PASSWORD_ROUNDS", 535000))
+HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", min(4, os.cpu_count() or 1)))
+
+# min == max == default, so any hash made under another policy needs an update
+pwd_context = CryptContext(
+    schemes=["sha256_crypt"],
+    deprecated="auto",
+    sha256_crypt__default_rounds=PASSWORD_ROUNDS,
+    sha256_crypt__min_rounds=PASSWORD_ROUNDS,
+    sha256_crypt__max_rounds=PASSWORD_ROUNDS
+)
+
+# Hashing is CPU bound and passlib's os_crypt backend holds the GIL for the
+# whole hash, so threads would still stall the event loop. A small process
+# pool keeps it off the loop and caps how many run at once during a login storm.
+_executor = None
+
+
+def _pool() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=HASH_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _executor
+
+
+def _truncate(password: str) -> str:
+    # Truncate password to 72 bytes for bcrypt compatibility
+    return password.encode('utf-8')[:72].decode('utf-8', 'ignore')
+
+
+def _hash(password: str) -> str:
+    # Runs inside a worker process
+    return pwd_context.hash(password)
+
+
+def _verify_and_update(password: str, password_hash: str) -> Tuple[bool, Optional[str]]:
+    return pwd_context.verify_and_update(password, password_hash)
+
+
+async def hash_password(password: str) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_pool(), _hash, _truncate(password))
+
+
+async def verify_password(password: str, password_hash: str) -> Tuple[bool, Optional[str]]:
+    """Check ``password``; also returns a replacement hash when the stored one is off-policy."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_pool(), _verify_and_update, _truncate(password), password_hash)
+
+
+async def start_pool():
+    # Spawning the workers costs a few hundred ms; pay it at startup, not on the first login
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_pool(), _truncate, "")
+
+
+def close_pool():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
@@ -0,0 +1,356 @@
+import html
+import math
+import re
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+from conversations import estimate_tokens
+
+K1 = 1.2
+B = 0.75
+MAX_POSTINGS_PER_TERM = 10000
+MAX_PASSAGE_POSTINGS = 2000
+SNIPPET_RADIUS = 120
+PASSAGE_WORDS = 120
+PASSAGE_OVERLAP = 30
+
+_WORD_RE = re.compile(r"[\w\u0640\u064B-\u065F\u0670]+")
+_DIACRITICS_RE = re.compile(r"[\u0640\u064B-\u065F\u0670]")
+_CHAR_MAP = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    "ى": "ي", "ئ": "ي", "ؤ": "و", "ة": "ه",
+    "٠": "0", "١": "1", "٢": "2", "٣": "3", "٤": "4",
+    "٥": "5", "٦": "6", "٧": "7", "٨": "8", "٩": "9",
+})
+_PREFIXES = ("وال", "بال", "كال", "فال", "لل", "ال")
+_STOPWORDS = {
+    "في", "من", "علي", "الي", "عن", "مع", "او", "ان", "هذا", "هذه", "التي",
+    "الذي", "ما", "لا", "كل", "قد", "the", "of", "and", "to", "in", "a", "is",
+}
+
+
+def normalize_arabic(text: str) -> str:
+    text = _DIACRITICS_RE.sub("", text)
+    return text.translate(_CHAR_MAP).lower()
+
+
+def normalize_token(word: str) -> Optional[str]:
+    term = normalize_arabic(word)
+    if term in _STOPWORDS:
+        return None
+    for prefix in _PREFIXES:
+        if term.startswith(prefix) and len(term) - len(prefix) >= 2:
+            term = term[len(prefix):]
+            break
+    if len(term) < 2 and not term.isdigit():
+        return None
+    return term
+
+
+def iter_tokens(text: str) -> Iterator[Tuple[str, int, int]]:
+    for match in _WORD_RE.finditer(text):
+        term = normalize_token(match.group())
+        if term:
+            yield term, match.start(), match.end()
+
+
+def tokenize(text: str) -> List[str]:
+    return [term for term, _, _ in iter_tokens(text)]
+
+
+def chunk_text(text: str, size: int = PASSAGE_WORDS, overlap: int = PASSAGE_OVERLAP) -> List[str]:
+    words = text.split()
+    chunks = []
+    step = max(size - overlap, 1)
+    for start in range(0, len(words), step):
+        chunks.append(" ".join(words[start:start + size]))
+        if start + size >= len(words):
+            break
+    return chunks
+
+
+def bm25(tf: int, n: int, count: int, length: float, avg_length: float) -> float:
+    idf = math.log(1 + (count - n + 0.5) / (n + 0.5))
+    return idf * tf * (K1 + 1) / (tf + K1 * (1 - B + B * length / avg_length))
+
+
+def highlight(text: str, terms, radius: int = SNIPPET_RADIUS) -> str:
+    spans = [(start, end) for term, start, end in iter_tokens(text) if term in terms]
+    if not spans:
+        return html.escape(text[:2 * radius])
+
+    window_start = max(spans[0][0] - radius, 0)
+    window_end = min(spans[0][1] + radius, len(text))
+    parts = []
+    cursor = window_start
+    for start, end in spans:
+        if start < window_start or end > window_end:
+            continue
+        parts.append(html.escape(text[cursor:start]))
+        parts.append(f"<mark>{html.escape(text[start:end])}</mark>")
+        cursor = end
+    parts.append(html.escape(text[cursor:window_end]))
+
+    snippet = "".join(parts).strip()
+    if window_start > 0:
+        snippet = "…" + snippet
+    if window_end < len(text):
+        snippet += "…"
+    return snippet
+
+
+class SearchIndex:
+    """BM25 inverted index over document OCR text, stored in Mongo.
+
+    ``search_postings`` holds one row per (term, document) with the term
+    frequency and the pages it occurs on; ``search_terms`` and
+    ``search_docs`` keep document frequencies and lengths so scores can be
+    computed without touching the documents themselves.
+
+    Alongside it, each document is cut into overlapping passages kept in
+    ``case_passages`` with postings keyed by case, so AI chats scoped to a
+    case can pull the best passages without scoring the whole corpus.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    async def _load_pages(self, doc: dict) -> List[str]:
+        if doc.get("sha256"):
+            pages = await self.db.document_pages.find(
+                {"sha256": doc["sha256"]}, {"_id": 0, "text": 1}
+            ).sort("page", 1).to_list(None)
+            if pages:
+                return [p["text"] for p in pages]
+        return [doc.get("ocr_text", "")]
+
+    async def index_document(self, doc: dict):
+        await self.remove_document(doc["id"])
+
+        pages = await self._load_pages(doc)
+        await self._index_passages(doc, pages)
+
+        stats: Dict[str, dict] = defaultdict(lambda: {"tf": 0, "pages": set()})
+        length = 0
+        for page_number, text in enumerate(pages, start=1):
+            for term in tokenize(text):
+                stats[term]["tf"] += 1
+                stats[term]["pages"].add(page_number)
+                length += 1
+        if not stats:
+            return
+
+        await self.db.search_postings.insert_many([
+            {
+                "term": term,
+                "doc_id": doc["id"],
+                "case_id": doc.get("case_id"),
+                "tf": s["tf"],
+                "pages": sorted(s["pages"])
+            }
+            for term, s in stats.items()
+        ])
+        await self.db.search_terms.bulk_write(
+            [UpdateOne({"term": term}, {"$inc": {"df": 1}}, upsert=True) for term in stats],
+            ordered=False
+        )
+        await self.db.search_docs.update_one(
+            {"doc_id": doc["id"]}, {"$set": {"doc_id": doc["id"], "length": length}}, upsert=True
+        )
+        await self.db.search_stats.update_one(
+            {"_id": "global"}, {"$inc": {"doc_count": 1, "total_length": length}}, upsert=True
+        )
+
+    async def index_blob(self, sha256: str):
+        async for doc in self.db.documents.find({"sha256": sha256}, {"_id": 0}):
+            await self.index_document(doc)
+
+    async def _index_passages(self, doc: dict, pages: List[str]):
+        case_id = doc.get("case_id")
+        passages = []
+        postings = []
+        for page_number, text in enumerate(pages, start=1):
+            for chunk in chunk_text(text):
+                terms = tokenize(chunk)
+                if not terms:
+                    continue
+                passage_id = f"{doc['id']}:{len(passages)}"
+                passages.append({
+                    "id": passage_id,
+                    "case_id": case_id,
+                    "doc_id": doc["id"],
+                    "title": doc.get("title", ""),
+                    "page": page_number,
+                    "text": chunk,
+                    "length": len(terms)
+                })
+                counts: Dict[str, int] = defaultdict(int)
+                for term in terms:
+                    counts[term] += 1
+                postings.extend(
+                    {"case_id": case_id, "term": term, "passage_id": passage_id, "doc_id": doc["id"], "tf": tf, "length": len(terms)}
+                    for term, tf in counts.items()
+                )
+        if not passages:
+            return
+
+        await self.db.case_passages.insert_many(passages)
+        await self.db.case_passage_postings.insert_many(postings)
+        await self.db.case_passage_stats.update_one(
+            {"_id": case_id},
+            {"$inc": {"count": len(passages), "total_length": sum(p["length"] for p in passages)}},
+            upsert=True
+        )
+
+    async def _remove_passages(self, doc_id: str):
+        passages = await self.db.case_passages.find(
+            {"doc_id": doc_id}, {"_id": 0, "case_id": 1, "length": 1}
+        ).to_list(None)
+        if not passages:
+            return
+        await self.db.case_passage_postings.delete_many({"doc_id": doc_id})
+        await self.db.case_passages.delete_many({"doc_id": doc_id})
+        await self.db.case_passage_stats.update_one(
+            {"_id": passages[0]["case_id"]},
+            {"$inc": {"count": -len(passages), "total_length": -sum(p["length"] for p in passages)}}
+        )
+
+    async def remove_document(self, doc_id: str):
+        await self._remove_passages(doc_id)
+        entry = await self.db.search_docs.find_one_and_delete({"doc_id": doc_id})
+        if not entry:
+            return
+
+        terms = await self.db.search_postings.distinct("term", {"doc_id": doc_id})
+        if terms:
+            await self.db.search_terms.bulk_write(
+                [UpdateOne({"term": term}, {"$inc": {"df": -1}}) for term in terms],
+                ordered=False
+            )
+        await self.db.search_postings.delete_many({"doc_id": doc_id})
+        await self.db.search_stats.update_one(
+            {"_id": "global"}, {"$inc": {"doc_count": -1, "total_length": -entry["length"]}}
+        )
+
+    async def search(self, q: str, case_ids: Optional[List[str]] = None, page: int = 1, page_size: int = 20) -> dict:
+        terms = list(dict.fromkeys(tokenize(q)))
+        result = {"total": 0, "page": page, "page_size": page_size, "hits": []}
+        if not terms:
+            return result
+
+        stats = await self.db.search_stats.find_one({"_id": "global"}) or {}
+        doc_count = max(stats.get("doc_count", 0), 1)
+        avg_length = max(stats.get("total_length", 0), 1) / doc_count
+        df = {
+            t["term"]: t["df"]
+            async for t in self.db.search_terms.find({"term": {"$in": terms}}, {"_id": 0})
+        }
+
+        # Highest-tf postings first, capped per term, so very common terms
+        # cannot turn a query back into a scan of the whole index.
+        postings = []
+        for term in terms:
+            if not df.get(term):
+                continue
+            query = {"term": term}
+            if case_ids is not None:
+                query["case_id"] = {"$in": case_ids}
+            postings.extend(
+                await self.db.search_postings.find(query, {"_id": 0})
+                .sort("tf", -1).limit(MAX_POSTINGS_PER_TERM).to_list(None)
+            )
+        if not postings:
+            return result
+
+        doc_ids = list({p["doc_id"] for p in postings})
+        lengths = {
+            d["doc_id"]: d["length"]
+            async for d in self.db.search_docs.find({"doc_id": {"$in": doc_ids}}, {"_id": 0})
+        }
+
+        scores: Dict[str, float] = defaultdict(float)
+        best_page: Dict[str, Tuple[float, int]] = {}
+        for p in postings:
+            length = lengths.get(p["doc_id"], avg_length)
+            score = bm25(p["tf"], df[p["term"]], doc_count, length, avg_length)
+            scores[p["doc_id"]] += score
+            if p["pages"] and score > best_page.get(p["doc_id"], (0, 0))[0]:
+                best_page[p["doc_id"]] = (score, p["pages"][0])
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        result["total"] = len(ranked)
+        window = ranked[(page - 1) * page_size:page * page_size]
+        if not window:
+            return result
+
+        docs = {
+            d["id"]: d
+            async for d in self.db.documents.find({"id": {"$in": [doc_id for doc_id, _ in window]}}, {"_id": 0})
+        }
+        term_set = set(terms)
+        for doc_id, score in window:
+            doc = docs.get(doc_id)
+            if not doc:
+                continue
+            page_number = best_page.get(doc_id, (0, 1))[1]
+            text = doc.pop("ocr_text", "")
+            if doc.get("sha256"):
+                page_doc = await self.db.document_pages.find_one(
+                    {"sha256": doc["sha256"], "page": page_number}, {"_id": 0, "text": 1}
+                )
+                if page_doc:
+                    text = page_doc["text"]
+            result["hits"].append({
+                "document": doc,
+                "score": round(score, 4),
+                "page": page_number,
+                "snippet": highlight(text, term_set)
+            })
+        return result
+
+    async def retrieve(self, case_id: str, q: str, k: int = 5, token_budget: int = 1500) -> List[dict]:
+        """Best-scoring passages of one case for ``q``, at most ``k`` and within ``token_budget``."""
+        terms = list(dict.fromkeys(tokenize(q)))
+        if not terms:
+            return []
+        stats = await self.db.case_passage_stats.find_one({"_id": case_id})
+        if not stats or stats.get("count", 0) <= 0:
+            return []
+        count = stats["count"]
+        avg_length = max(stats.get("total_length", 0), 1) / count
+
+        # Per-case document frequency is the number of postings for the term,
+        # exact unless the term is common enough to hit the cap.
+        scores: Dict[str, float] = defaultdict(float)
+        for term in terms:
+            postings = await self.db.case_passage_postings.find(
+                {"case_id": case_id, "term": term}, {"_id": 0, "passage_id": 1, "tf": 1, "length": 1}
+            ).sort("tf", -1).limit(MAX_PASSAGE_POSTINGS).to_list(None)
+            for p in postings:
+                scores[p["passage_id"]] += bm25(p["tf"], len(postings), count, p["length"], avg_length)
+        if not scores:
+            return []
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k * 4]
+        passages = {
+            p["id"]: p
+            async for p in self.db.case_passages.find(
+                {"id": {"$in": [passage_id for passage_id, _ in ranked]}}, {"_id": 0}
+            )
+        }
+        selected = []
+        used = 0
+        for passage_id, score in ranked:
+            passage = passages.get(passage_id)
+            if not passage:
+                continue
+            cost = estimate_tokens(passage["text"])
+            if used + cost > token_budget:
+                continue
+            used += cost
+            selected.append({**passage, "score": round(score, 4)})
+            if len(selected) == k:
+                break
+        return selected
@@ -0,0 +1,81 @@
+import asyncio
+import os
+from datetime import datetime, timezone
+from typing import Dict, List
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+INVOICE_PREFIXES = {
+    "fees": "FEES",
+    "expenses": "EXP",
+    "receipt": "RCPT",
+    "credit_note": "CN",
+    "debit_note": "DN"
+}
+
+
+class InvoiceNumberAllocator:
+    """Atomic per (company, type, year) invoice counters.
+
+    Counters live in ``invoice_sequences`` and are advanced with a single
+    ``$inc``. With ``block_size`` > 1 each worker reserves that many numbers
+    at a time and hands them out locally, so batch invoicing does not
+    serialize on one counter document; numbers left in a block when the
+    process exits are skipped.
+    """
+
+    def __init__(self, db, block_size: int = None):
+        self.db = db
+        self.block_size = block_size or int(os.getenv("INVOICE_NUMBER_BLOCK", 1))
+        self._blocks: Dict[str, List[int]] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._seeded = set()
+
+    async def _seed(self, key: str, company_id: str, invoice_type: str, prefix: str, year: int):
+        # Start a new counter after the highest number issued before counters existed
+        # of this company's type and year; an existing counter is never moved
+        if key in self._seeded:
+            return
+        if await self.db.invoice_sequences.find_one({"_id": key}, {"_id": 1}) is None:
+            last_invoice = await self.db.invoices.find_one(
+                {"company_id": company_id, "type": invoice_type,
+                 "invoice_number": {"$regex": f"^{prefix}-{year}-"}},
+                {"_id": 0, "invoice_number": 1},
+                sort=[("invoice_number", -1)]
+            )
+            last_num = int(last_invoice["invoice_number"].split("-")[-1]) if last_invoice else 0
+            try:
+                await self.db.invoice_sequences.update_one(
+                    {"_id": key},
+                    {"$setOnInsert": {"value": last_num}},
+                    upsert=True
+                )
+            except DuplicateKeyError:
+                pass  # another worker created the counter first
+        self._seeded.add(key)
+
+    async def _reserve(self, key: str, count: int) -> List[int]:
+        counter = await self.db.invoice_sequences.find_one_and_update(
+            {"_id": key},
+            {"$inc": {"value": count}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        last = counter["value"]
+        return list(range(last - count + 1, last + 1))
+
+    async def allocate(self, company_id: str, invoice_type: str, count: int = 1) -> List[str]:
+        year = datetime.now(timezone.utc).year
+        prefix = INVOICE_PREFIXES.get(invoice_type, "INV")
+        key = f"{company_id or '-'}:{invoice_type}:{year}"
+        await self._seed(key, company_id, invoice_type, prefix, year)
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            block = self._blocks.setdefault(key, [])
+            if len(block) < count:
+                block.extend(await self._reserve(key, max(self.block_size, count - len(block))))
+            numbers, self._blocks[key] = block[:count], block[count:]
+
+        return [f"{prefix}-{year}-{n:06d}" for n in numbers]
@@ -1,25 +1,40 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Header, Query, Form
-from fastapi.responses import StreamingResponse, FileResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Header, Query, Form, Response, Request
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+import asyncio
+import json
+import math
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
 from typing import List, Optional, Dict, Any
 from datetime import datetime, timezone, timedelta
-from passlib.context import CryptContext
 import jwt
 import os
 import logging
 import uuid
-import shutil
 from pathlib import Path
-import pytesseract
-from PIL import Image
-from pdf2image import convert_from_path
-import tempfile
 import io
-from manus_ai_integration import LlmChat, UserMessage
+from manus_ai_integration import LlmChat, UserMessage, close_clients, RETRYABLE_ERRORS
+from ocr_worker import OCRWorkerPool, OCR_EXTENSIONS
+from storage import BlobStore, storage_from_env, unmigrated_collections
+from search_index import SearchIndex
+from db_indexes import ensure_indexes
+from auth_cache import AuthCache
+from sequences import InvoiceNumberAllocator
+from stats import CompanyStats
+from pagination import paginate, NEXT_CURSOR_HEADER, MAX_PAGE_SIZE
+from tenant_export import stream_export
+from conversations import ConversationStore
+from ai_cache import AIResponseCache, cache_key
+from ai_limits import AIGate, AIRejected
+from passwords import hash_password, verify_password, start_pool, close_pool
+from bulk import BULK_MAX_ITEMS, BulkReport, insert_unordered
+from hearings import session_at, day_bounds
+from downloads import DocumentFileCache, file_response
+from drive_sync import DriveSyncWorker
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
 from google_auth_oauthlib.flow import Flow
@@ -36,12 +51,24 @@ db = client[os.environ['DB_NAME']]
 app = FastAPI()
 api_router = APIRouter(prefix="/api")
 security = HTTPBearer()
-pwd_context = CryptContext(schemes=["sha256_crypt"], deprecated="auto")
 logger = logging.getLogger(__name__)
 
 UPLOAD_DIR = ROOT_DIR / "uploads"
 UPLOAD_DIR.mkdir(exist_ok=True)
 
+storage = storage_from_env(UPLOAD_DIR)
+blob_store = BlobStore(db, storage, UPLOAD_DIR / "tmp")
+auth_cache = AuthCache(db)
+invoice_numbers = InvoiceNumberAllocator(db)
+company_stats = CompanyStats(db)
+search_index = SearchIndex(db)
+conversation_store = ConversationStore(db)
+ai_cache = AIResponseCache(db)
+ai_gate = AIGate()
+document_files = DocumentFileCache(db, storage)
+ocr_pool = OCRWorkerPool(db, storage, on_done=search_index.index_blob)
+drive_sync = DriveSyncWorker(db, storage)
+
 class User(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -52,8 +79,16 @@ class User(BaseModel):
     full_name_en: str = ""
     avatar_url: str = ""
     company_id: Optional[str] = None
+    token_version: int = 0
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
+class AuthUser(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str
+    email: EmailStr
+    role: str = "user"
+    company_id: Optional[str] = None
+
 class UserCreate(BaseModel):
     email: EmailStr
     password: str
@@ -120,6 +155,9 @@ class Session(BaseModel):
     notes_ar: str = ""
     notes_en: str = ""
     status: str = "scheduled"
+    company_id: str = ""
+    user_id: str = ""
+    session_at: Optional[str] = None
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
 class SessionCreate(BaseModel):
@@ -136,21 +174,28 @@ class Document(BaseModel):
     case_id: str
     title: str
     file_name: str
-    file_path: str
+    storage_key: str = ""
     file_size: int
+    sha256: Optional[str] = None
     gdrive_file_id: Optional[str] = None
+    drive_status: Optional[str] = None
     ocr_text: str = ""
+    ocr_status: str = "done"
+    page_count: int = 0
     uploaded_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
 class Invoice(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     case_id: str
+    company_id: str = ""
     invoice_number: str
     type: str
     amount: float
     vat_amount: float = 0.0
     total_amount: float
+    amount_paid: float = 0.0
+    balance_due: float = 0.0
     status: str = "pending"
     description_ar: str = ""
     issued_date: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
@@ -206,6 +251,9 @@ class AIConversation(BaseModel):
     user_id: str
     case_id: Optional[str] = None
     messages: List[Dict[str, Any]] = []
+    message_count: int = 0
+    summary: Optional[str] = None
+    summary_upto: int = 0
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
 class AIRequest(BaseModel):
@@ -215,11 +263,13 @@ class AIRequest(BaseModel):
     provider: str = "openai"
     model: str = "gpt-5.2"
 
-def create_token(user_id: str, email: str, role: str) -> str:
+def create_token(user: User) -> str:
     payload = {
-        "user_id": user_id,
-        "email": email,
-        "role": role,
+        "user_id": user.id,
+        "email": user.email,
+        "role": user.role,
+        "company_id": user.company_id,
+        "ver": user.token_version,
         "exp": datetime.now(timezone.utc) + timedelta(days=7)
     }
     return jwt.encode(payload, os.getenv("JWT_SECRET"), algorithm="HS256")
@@ -229,10 +279,19 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         token = credentials.credentials
         payload = jwt.decode(token, os.getenv("JWT_SECRET"), algorithms=["HS256"])
         user_id = payload["user_id"]
-        user_doc = await db.users.find_one({"id": user_id}, {"_id": 0})
+        # Trust the claims unless the user's role/company changed after issue
+        if "ver" in payload and auth_cache.is_current(user_id, payload["ver"]):
+            return AuthUser(
+                id=user_id,
+                email=payload["email"],
+                role=payload["role"],
+                company_id=payload.get("company_id")
+            )
+        
+        user_doc = await auth_cache.get_user(user_id)
         if not user_doc:
             raise HTTPException(status_code=401, detail="User not found")
-        return User(**user_doc)
+        return AuthUser(**user_doc)
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except Exception as e:
@@ -248,9 +307,7 @@ async def register(user_data: UserCreate):
     if existing:
         raise HTTPException(status_code=400, detail="Email already registered")
     
-    # Truncate password to 72 bytes for bcrypt compatibility
-    password_to_hash = user_data.password.encode('utf-8')[:72].decode('utf-8', 'ignore')
-    password_hash = pwd_context.hash(password_to_hash)
+    password_hash = await hash_password(user_data.password)
     user = User(
         email=user_data.email,
         password_hash=password_hash,
@@ -262,17 +319,27 @@ async def register(user_data: UserCreate):
     doc = user.model_dump()
     await db.users.insert_one(doc)
     
-    token = create_token(user.id, user.email, user.role)
+    token = create_token(user)
     return {"token": token, "user": {"id": user.id, "email": user.email, "full_name_ar": user.full_name_ar, "role": user.role}}
 
 @api_router.post("/auth/login")
 async def login(credentials: UserLogin):
     user_doc = await db.users.find_one({"email": credentials.email}, {"_id": 0})
-    if not user_doc or not pwd_context.verify(credentials.password, user_doc["password_hash"]):
+    if not user_doc:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    valid, new_hash = await verify_password(credentials.password, user_doc["password_hash"])
+    if not valid:
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    if new_hash:
+        # Stored hash predates the current rounds policy
+        await db.users.update_one(
+            {"id": user_doc["id"], "password_hash": user_doc["password_hash"]},
+            {"$set": {"password_hash": new_hash}}
+        )
+        auth_cache.invalidate(user_doc["id"])
     
     user = User(**user_doc)
-    token = create_token(user.id, user.email, user.role)
+    token = create_token(user)
     
     company = None
     if user.company_id:
@@ -295,7 +362,12 @@ async def login(credentials: UserLogin):
     }
 
 @api_router.get("/auth/me")
-async def get_me(user: User = Depends(get_current_user)):
+async def get_me(current_user: AuthUser = Depends(get_current_user)):
+    user_doc = await auth_cache.get_user(current_user.id)
+    if not user_doc:
+        raise HTTPException(status_code=404, detail="User not found")
+    user = User(**user_doc)
+    
     company = None
     if user.company_id:
         company_doc = await db.companies.find_one({"id": user.company_id}, {"_id": 0})
@@ -308,7 +380,7 @@ async def get_me(user: User = Depends(get_current_user)):
     }
 
 @api_router.put("/users/{user_id}")
-async def update_user(user_id: str, update_data: dict, current_user: User = Depends(get_current_user)):
+async def update_user(user_id: str, update_data: dict, current_user: AuthUser = Depends(get_current_user)):
     if current_user.id != user_id and current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Not authorized")
     
@@ -319,11 +391,12 @@ async def update_user(user_id: str, update_data: dict, current_user: User = Depe
         raise HTTPException(status_code=400, detail="No valid fields to update")
     
     await db.users.update_one({"id": user_id}, {"$set": update_fields})
+    await auth_cache.publish_invalidation(user_id)
     updated = await db.users.find_one({"id": user_id}, {"_id": 0})
     return User(**updated)
 
 @api_router.post("/companies")
-async def create_company(company_data: CompanyCreate, user: User = Depends(get_current_user)):
+async def create_company(company_data: CompanyCreate, user: AuthUser = Depends(get_current_user)):
     if user.role != "admin":
         raise HTTPException(status_code=403, detail="Only admins can create companies")
     
@@ -334,11 +407,12 @@ async def create_company(company_data: CompanyCreate, user: User = Depends(get_c
         {"id": user.id},
         {"$set": {"company_id": company.id}}
     )
+    await auth_cache.revoke_claims(user.id)
     
     return company
 
 @api_router.put("/companies/{company_id}")
-async def update_company(company_id: str, company_data: CompanyCreate, user: User = Depends(get_current_user)):
+async def update_company(company_id: str, company_data: CompanyCreate, user: AuthUser = Depends(get_current_user)):
     if user.role != "admin":
         raise HTTPException(status_code=403, detail="Only admins can update companies")
     
@@ -350,36 +424,129 @@ async def update_company(company_id: str, company_data: CompanyCreate, user: Use
     updated = await db.companies.find_one({"id": company_id}, {"_id": 0})
     return Company(**updated)
 
+def filters(**values) -> dict:
+    return {k: v for k, v in values.items() if v is not None}
+
 @api_router.get("/cases", response_model=List[Case])
-async def get_cases(user: User = Depends(get_current_user)):
-    query = {}
+async def get_cases(
+    response: Response,
+    status: Optional[str] = None,
+    type: Optional[str] = None,
+    priority: Optional[str] = None,
+    court: Optional[str] = None,
+    sort: str = "created_at",
+    limit: int = Query(MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    fields: Optional[str] = None,
+    user: AuthUser = Depends(get_current_user)
+):
+    query = filters(status=status, type=type, priority=priority, court=court)
     if user.role != "admin":
         query["user_id"] = user.id
     elif user.company_id:
         query["company_id"] = user.company_id
     
-    cases = await db.cases.find(query, {"_id": 0}).to_list(1000)
-    return [Case(**case) for case in cases]
+    return await paginate(db.cases, query, Case, response, sort=sort, limit=limit, after=after, fields=fields)
 
 @api_router.post("/cases")
-async def create_case(case_data: CaseCreate, user: User = Depends(get_current_user)):
+async def create_case(case_data: CaseCreate, user: AuthUser = Depends(get_current_user)):
     case = Case(
         **case_data.model_dump(),
         company_id=user.company_id or "",
         user_id=user.id
     )
     await db.cases.insert_one(case.model_dump())
+    await company_stats.case_changed(None, case.model_dump())
     return case
 
+def check_bulk_size(items: list):
+    if len(items) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {BULK_MAX_ITEMS} items per request")
+
+@api_router.post("/cases/bulk")
+async def create_cases_bulk(items: List[Dict[str, Any]], user: AuthUser = Depends(get_current_user)):
+    check_bulk_size(items)
+    report = BulkReport(len(items))
+    rows = [
+        (index, Case(**case_data.model_dump(), company_id=user.company_id or "", user_id=user.id).model_dump())
+        for index, case_data in report.validate(items, CaseCreate)
+    ]
+    written = await insert_unordered(db.cases, rows, report)
+    await company_stats.cases_added(written)
+    return report.as_dict()
+
 @api_router.get("/cases/{case_id}")
-async def get_case(case_id: str, user: User = Depends(get_current_user)):
+async def get_case(case_id: str, user: AuthUser = Depends(get_current_user)):
     case_doc = await db.cases.find_one({"id": case_id}, {"_id": 0})
     if not case_doc:
         raise HTTPException(status_code=404, detail="Case not found")
     return Case(**case_doc)
 
+OVERVIEW_SESSIONS = 10
+OVERVIEW_DOCUMENTS = 100
+
+async def invoice_totals(case_id: str) -> dict:
+    rows = await db.invoices.aggregate([
+        {"$match": {"case_id": case_id}},
+        {"$group": {
+            "_id": "$status",
+            "count": {"$sum": 1},
+            "total_amount": {"$sum": "$total_amount"},
+            "amount_paid": {"$sum": "$amount_paid"},
+            "balance_due": {"$sum": "$balance_due"}
+        }}
+    ]).to_list(None)
+    by_status = {row.pop("_id"): row for row in rows}
+    totals = {
+        field: sum(row[field] for row in by_status.values())
+        for field in ["count", "total_amount", "amount_paid", "balance_due"]
+    }
+    return {**totals, "by_status": by_status}
+
+async def payment_summary(case_id: str) -> dict:
+    rows = await db.payments.aggregate([
+        {"$match": {"case_id": case_id}},
+        {"$group": {
+            "_id": "$method",
+            "count": {"$sum": 1},
+            "amount": {"$sum": "$amount"},
+            "last_payment_date": {"$max": "$payment_date"}
+        }}
+    ]).to_list(None)
+    by_method = {row.pop("_id"): row for row in rows}
+    return {
+        "count": sum(row["count"] for row in by_method.values()),
+        "amount": sum(row["amount"] for row in by_method.values()),
+        "last_payment_date": max((row["last_payment_date"] for row in by_method.values()), default=None),
+        "by_method": by_method
+    }
+
+@api_router.get("/cases/{case_id}/overview")
+async def get_case_overview(case_id: str, user: AuthUser = Depends(get_current_user)):
+    now = datetime.now(timezone.utc).replace(microsecond=0).isoformat()
+    case_doc, upcoming, session_count, documents, invoices, payments = await asyncio.gather(
+        db.cases.find_one({"id": case_id}, {"_id": 0}),
+        db.sessions.find({"case_id": case_id, "session_at": {"$gte": now}}, {"_id": 0})
+        .sort([("session_at", 1), ("id", 1)]).to_list(OVERVIEW_SESSIONS),
+        db.sessions.count_documents({"case_id": case_id}),
+        db.documents.find({"case_id": case_id}, {"_id": 0, "ocr_text": 0, "storage_key": 0})
+        .sort([("uploaded_at", -1), ("id", -1)]).to_list(OVERVIEW_DOCUMENTS),
+        invoice_totals(case_id),
+        payment_summary(case_id)
+    )
+    if not case_doc:
+        raise HTTPException(status_code=404, detail="Case not found")
+    
+    return {
+        "case": Case(**case_doc),
+        "sessions": {"total": session_count, "upcoming": upcoming},
+        "documents": documents,
+        "invoices": invoices,
+        "payments": payments
+    }
+
 @api_router.put("/cases/{case_id}")
-async def update_case(case_id: str, case_data: CaseCreate, user: User = Depends(get_current_user)):
+async def update_case(case_id: str, case_data: CaseCreate, user: AuthUser = Depends(get_current_user)):
     await db.cases.update_one(
         {"id": case_id},
         {"$set": case_data.model_dump()}
@@ -388,32 +555,131 @@ async def update_case(case_id: str, case_data: CaseCreate, user: User = Depends(
     return Case(**updated)
 
 @api_router.delete("/cases/{case_id}")
-async def delete_case(case_id: str, user: User = Depends(get_current_user)):
-    await db.cases.delete_one({"id": case_id})
+async def delete_case(case_id: str, user: AuthUser = Depends(get_current_user)):
+    case_doc = await db.cases.find_one_and_delete({"id": case_id}, projection={"_id": 0})
+    await company_stats.case_changed(case_doc, None)
     return {"message": "Case deleted"}
 
 @api_router.get("/cases/{case_id}/sessions", response_model=List[Session])
-async def get_sessions(case_id: str, user: User = Depends(get_current_user)):
-    sessions = await db.sessions.find({"case_id": case_id}, {"_id": 0}).to_list(1000)
-    return [Session(**session) for session in sessions]
+async def get_sessions(
+    case_id: str,
+    response: Response,
+    status: Optional[str] = None,
+    sort: str = "session_date",
+    limit: int = Query(MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    fields: Optional[str] = None,
+    user: AuthUser = Depends(get_current_user)
+):
+    query = {"case_id": case_id, **filters(status=status)}
+    return await paginate(db.sessions, query, Session, response, sort=sort, limit=limit, after=after, fields=fields)
+
+async def case_owners(case_ids: List[str]) -> Dict[str, dict]:
+    return {
+        c["id"]: c
+        async for c in db.cases.find({"id": {"$in": list(set(case_ids))}}, {"_id": 0, "id": 1, "company_id": 1, "user_id": 1})
+    }
+
+def build_session(session_data: SessionCreate, owner: Optional[dict]) -> Session:
+    # Owner and a normalized UTC time are copied on so calendars need no join
+    owner = owner or {}
+    return Session(
+        **session_data.model_dump(),
+        company_id=owner.get("company_id", ""),
+        user_id=owner.get("user_id", ""),
+        session_at=session_at(session_data.session_date, session_data.session_time)
+    )
 
 @api_router.post("/sessions")
-async def create_session(session_data: SessionCreate, user: User = Depends(get_current_user)):
-    session = Session(**session_data.model_dump())
+async def create_session(session_data: SessionCreate, user: AuthUser = Depends(get_current_user)):
+    owners = await case_owners([session_data.case_id])
+    session = build_session(session_data, owners.get(session_data.case_id))
     await db.sessions.insert_one(session.model_dump())
     return session
 
+@api_router.post("/sessions/bulk")
+async def create_sessions_bulk(items: List[Dict[str, Any]], user: AuthUser = Depends(get_current_user)):
+    check_bulk_size(items)
+    report = BulkReport(len(items))
+    valid = report.validate(items, SessionCreate)
+    owners = await case_owners([session_data.case_id for _, session_data in valid])
+    rows = [
+        (index, build_session(session_data, owners.get(session_data.case_id)).model_dump())
+        for index, session_data in valid
+    ]
+    await insert_unordered(db.sessions, rows, report)
+    return report.as_dict()
+
+SESSION_CASE_FIELDS = ["case_number", "title_ar", "court"]
+
+def session_scope(user: AuthUser) -> dict:
+    # Same visibility as /cases: own cases, or the whole company for admins
+    if user.role != "admin":
+        return {"user_id": user.id}
+    if user.company_id:
+        return {"company_id": user.company_id}
+    return {}
+
+async def sessions_between(query: dict, limit: int) -> List[dict]:
+    pipeline = [
+        {"$match": query},
+        {"$sort": {"session_at": 1, "id": 1}},
+        {"$limit": limit},
+        {"$project": {"_id": 0}},
+        {"$lookup": {"from": "cases", "localField": "case_id", "foreignField": "id", "as": "case"}},
+        {"$set": {"case": {f: {"$arrayElemAt": [f"$case.{f}", 0]} for f in SESSION_CASE_FIELDS}}}
+    ]
+    return await db.sessions.aggregate(pipeline).to_list(limit)
+
+@api_router.get("/sessions/calendar")
+async def get_session_calendar(
+    from_: str = Query(..., alias="from"),
+    to: str = Query(...),
+    status: Optional[str] = None,
+    limit: int = Query(500, ge=1, le=2000),
+    user: AuthUser = Depends(get_current_user)
+):
+    try:
+        start, end = day_bounds(from_, to)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if end <= start:
+        raise HTTPException(status_code=400, detail="'to' must not be before 'from'")
+    
+    query = {**session_scope(user), "session_at": {"$gte": start, "$lt": end}, **filters(status=status)}
+    return await sessions_between(query, limit)
+
+@api_router.get("/sessions/upcoming")
+async def get_upcoming_sessions(
+    days: int = Query(14, ge=1, le=365),
+    limit: int = Query(20, ge=1, le=200),
+    user: AuthUser = Depends(get_current_user)
+):
+    now = datetime.now(timezone.utc)
+    query = {
+        **session_scope(user),
+        "session_at": {
+            "$gte": now.replace(microsecond=0).isoformat(),
+            "$lt": (now + timedelta(days=days)).replace(microsecond=0).isoformat()
+        },
+        "status": "scheduled"
+    }
+    return await sessions_between(query, limit)
+
 @api_router.put("/sessions/{session_id}")
-async def update_session(session_id: str, session_data: SessionCreate, user: User = Depends(get_current_user)):
+async def update_session(session_id: str, session_data: SessionCreate, user: AuthUser = Depends(get_current_user)):
     await db.sessions.update_one(
         {"id": session_id},
-        {"$set": session_data.model_dump()}
+        {"$set": {
+            **session_data.model_dump(),
+            "session_at": session_at(session_data.session_date, session_data.session_time)
+        }}
     )
     updated = await db.sessions.find_one({"id": session_id}, {"_id": 0})
     return Session(**updated)
 
 @api_router.delete("/sessions/{session_id}")
-async def delete_session(session_id: str, user: User = Depends(get_current_user)):
+async def delete_session(session_id: str, user: AuthUser = Depends(get_current_user)):
     await db.sessions.delete_one({"id": session_id})
     return {"message": "Session deleted"}
 
@@ -422,41 +688,53 @@ async def upload_document(
     file: UploadFile = File(...),
     case_id: str = Form(...),
     title: str = Form(...),
-    user: User = Depends(get_current_user)
+    user: AuthUser = Depends(get_current_user)
 ):
     try:
-        file_id = str(uuid.uuid4())
         file_ext = Path(file.filename).suffix
-        file_name = f"{file_id}{file_ext}"
-        file_path = UPLOAD_DIR / file_name
-        
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        ocr_text = ""
-        if file_ext.lower() in [".pdf", ".png", ".jpg", ".jpeg"]:
-            try:
-                if file_ext.lower() == ".pdf":
-                    with tempfile.TemporaryDirectory() as temp_dir:
-                        images = convert_from_path(str(file_path), output_folder=temp_dir)
-                        for img in images:
-                            ocr_text += pytesseract.image_to_string(img, lang="ara+eng") + "\n"
-                else:
-                    img = Image.open(file_path)
-                    ocr_text = pytesseract.image_to_string(img, lang="ara+eng")
-            except Exception as e:
-                logger.warning(f"OCR failed: {e}")
+        blob = await blob_store.put(file, file_ext)
         
+        # Identical bytes share one OCR run: reuse a finished or in-flight result
+        needs_ocr = blob["file_ext"] in OCR_EXTENSIONS
+        ocr_status = blob.get("ocr_status") or ("pending" if needs_ocr else "done")
         document = Document(
             case_id=case_id,
             title=title,
             file_name=file.filename,
-            file_path=str(file_path),
-            file_size=file_path.stat().st_size,
-            ocr_text=ocr_text
+            storage_key=blob["key"],
+            file_size=blob["size"],
+            sha256=blob["sha256"],
+            ocr_text=blob.get("ocr_text", ""),
+            page_count=blob.get("page_count", 0),
+            ocr_status=ocr_status
         )
         
-        await db.documents.insert_one(document.model_dump())
+        try:
+            await db.documents.insert_one(document.model_dump())
+        except Exception:
+            await blob_store.release(blob["sha256"])
+            raise
+        if ocr_status in ("pending", "running"):
+            # A run that finished before the insert updated every document but this one
+            current = await db.blobs.find_one(
+                {"sha256": blob["sha256"]}, {"_id": 0, "ocr_status": 1, "ocr_text": 1, "page_count": 1}
+            )
+            if current and current.get("ocr_status") in ("done", "failed"):
+                result = {
+                    "ocr_status": current["ocr_status"],
+                    "ocr_text": current.get("ocr_text", ""),
+                    "page_count": current.get("page_count", 0)
+                }
+                await db.documents.update_one({"id": document.id}, {"$set": result})
+                document = document.model_copy(update=result)
+                ocr_status = result["ocr_status"]
+        if needs_ocr and blob.get("ocr_status") in (None, "failed"):
+            await ocr_pool.enqueue(blob["sha256"], blob["key"], blob["file_ext"])
+        elif ocr_status == "done":
+            await search_index.index_document(document.model_dump())
+        if await db.drive_credentials.find_one({"user_id": user.id}, {"_id": 0, "user_id": 1}):
+            await drive_sync.enqueue(document.model_dump(), user.id)
+            document.drive_status = "pending"
         return document
     
     except Exception as e:
@@ -464,146 +742,335 @@ async def upload_document(
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
 @api_router.get("/cases/{case_id}/documents", response_model=List[Document])
-async def get_documents(case_id: str, user: User = Depends(get_current_user)):
-    documents = await db.documents.find({"case_id": case_id}, {"_id": 0}).to_list(1000)
-    return [Document(**doc) for doc in documents]
+async def get_documents(
+    case_id: str,
+    response: Response,
+    ocr_status: Optional[str] = None,
+    sort: str = "uploaded_at",
+    limit: int = Query(MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    fields: Optional[str] = None,
+    user: AuthUser = Depends(get_current_user)
+):
+    query = {"case_id": case_id, **filters(ocr_status=ocr_status)}
+    return await paginate(db.documents, query, Document, response, sort=sort, limit=limit, after=after, fields=fields)
 
 @api_router.get("/documents/search")
 async def search_documents(
     q: str = Query(...),
     case_type: Optional[str] = None,
-    user: User = Depends(get_current_user)
+    case_id: Optional[str] = None,
+    page: int = Query(1, ge=1),
+    page_size: int = Query(20, ge=1, le=100),
+    user: AuthUser = Depends(get_current_user)
 ):
-    query = {"ocr_text": {"$regex": q, "$options": "i"}}
-    
-    if case_type:
-        case_ids = await db.cases.find({"type": case_type}, {"_id": 0, "id": 1}).to_list(1000)
-        query["case_id"] = {"$in": [c["id"] for c in case_ids]}
+    case_ids = None
+    if case_id:
+        case_ids = [case_id]
+    elif case_type:
+        cases = await db.cases.find({"type": case_type}, {"_id": 0, "id": 1}).to_list(None)
+        case_ids = [c["id"] for c in cases]
     
-    documents = await db.documents.find(query, {"_id": 0}).to_list(100)
-    return [Document(**doc) for doc in documents]
+    return await search_index.search(q, case_ids=case_ids, page=page, page_size=page_size)
 
-@api_router.get("/documents/{doc_id}/download")
-async def download_document(doc_id: str, user: User = Depends(get_current_user)):
-    doc = await db.documents.find_one({"id": doc_id}, {"_id": 0})
+@api_router.get("/documents/{doc_id}/ocr")
+async def get_ocr_status(doc_id: str, user: AuthUser = Depends(get_current_user)):
+    doc = await db.documents.find_one({"id": doc_id}, {"_id": 0, "id": 1, "sha256": 1, "ocr_status": 1})
     if not doc:
         raise HTTPException(status_code=404, detail="Document not found")
     
-    file_path = Path(doc["file_path"])
-    if not file_path.exists():
-        raise HTTPException(status_code=404, detail="File not found")
-    
-    return FileResponse(file_path, filename=doc["file_name"])
-
-async def generate_invoice_number(invoice_type: str) -> str:
-    year = datetime.now(timezone.utc).year
-    prefix_map = {
-        "fees": "FEES",
-        "expenses": "EXP",
-        "receipt": "RCPT",
-        "credit_note": "CN",
-        "debit_note": "DN"
+    job = None
+    if doc.get("sha256"):
+        job = await db.ocr_jobs.find_one({"sha256": doc["sha256"]}, {"_id": 0, "storage_key": 0, "file_ext": 0})
+    return {
+        "document_id": doc_id,
+        "ocr_status": doc.get("ocr_status", "done"),
+        "job": job
     }
-    prefix = prefix_map.get(invoice_type, "INV")
+
+@api_router.get("/documents/{doc_id}/download")
+async def download_document(doc_id: str, request: Request, user: AuthUser = Depends(get_current_user)):
+    meta = await document_files.get(doc_id)
+    if not meta:
+        raise HTTPException(status_code=404, detail="Document not found")
     
-    last_invoice = await db.invoices.find_one(
-        {"type": invoice_type, "invoice_number": {"$regex": f"^{prefix}-{year}"}},
-        {"_id": 0, "invoice_number": 1},
-        sort=[("created_at", -1)]
-    )
+    return await file_response(request, meta, storage)
+
+@api_router.delete("/documents/{doc_id}")
+async def delete_document(doc_id: str, user: AuthUser = Depends(get_current_user)):
+    doc = await db.documents.find_one_and_delete({"id": doc_id}, projection={"_id": 0})
+    if not doc:
+        raise HTTPException(status_code=404, detail="Document not found")
     
-    if last_invoice:
-        last_num = int(last_invoice["invoice_number"].split("-")[-1])
-        new_num = last_num + 1
-    else:
-        new_num = 1
+    document_files.invalidate(doc_id)
+    await db.drive_jobs.delete_one({"doc_id": doc_id, "status": {"$ne": "running"}})
+    await search_index.remove_document(doc_id)
+    if doc.get("sha256"):
+        await blob_store.release(doc["sha256"])
+    return {"message": "Document deleted"}
+
+@api_router.get("/documents/{doc_id}/pages")
+async def get_document_pages(
+    doc_id: str,
+    first_page: int = Query(1, ge=1),
+    last_page: Optional[int] = Query(None, ge=1),
+    user: AuthUser = Depends(get_current_user)
+):
+    doc = await db.documents.find_one({"id": doc_id}, {"_id": 0, "sha256": 1})
+    if not doc:
+        raise HTTPException(status_code=404, detail="Document not found")
+    if not doc.get("sha256"):
+        return []
     
-    return f"{prefix}-{year}-{new_num:06d}"
-
-@api_router.post("/invoices")
-async def create_invoice(invoice_data: InvoiceCreate, user: User = Depends(get_current_user)):
-    invoice_number = await generate_invoice_number(invoice_data.type)
+    page_query = {"$gte": first_page}
+    if last_page:
+        page_query["$lte"] = last_page
+    pages = await db.document_pages.find(
+        {"sha256": doc["sha256"], "page": page_query}, {"_id": 0, "sha256": 0}
+    ).sort("page", 1).to_list(1000)
+    return pages
+
+async def generate_invoice_number(invoice_type: str, company_id: Optional[str]) -> str:
+    numbers = await invoice_numbers.allocate(company_id, invoice_type)
+    return numbers[0]
+
+def build_invoice(invoice_data: InvoiceCreate, owner: Optional[dict], invoice_number: str) -> Invoice:
+    # The invoice belongs to its case's company, whoever creates it
     vat_amount = invoice_data.amount * (invoice_data.vat_percentage / 100)
     total_amount = invoice_data.amount + vat_amount
     
-    invoice = Invoice(
+    return Invoice(
         case_id=invoice_data.case_id,
+        company_id=(owner or {}).get("company_id", ""),
         invoice_number=invoice_number,
         type=invoice_data.type,
         amount=invoice_data.amount,
         vat_amount=vat_amount,
         total_amount=total_amount,
+        balance_due=total_amount,
         description_ar=invoice_data.description_ar,
         due_date=invoice_data.due_date
     )
+
+@api_router.post("/invoices")
+async def create_invoice(invoice_data: InvoiceCreate, user: AuthUser = Depends(get_current_user)):
+    owner = (await case_owners([invoice_data.case_id])).get(invoice_data.case_id) or {}
+    invoice_number = await generate_invoice_number(invoice_data.type, owner.get("company_id"))
+    invoice = build_invoice(invoice_data, owner, invoice_number)
     
     await db.invoices.insert_one(invoice.model_dump())
+    await company_stats.invoice_changed(None, invoice.model_dump())
     return invoice
 
+@api_router.post("/invoices/bulk")
+async def create_invoices_bulk(items: List[Dict[str, Any]], user: AuthUser = Depends(get_current_user)):
+    check_bulk_size(items)
+    report = BulkReport(len(items))
+    valid = report.validate(items, InvoiceCreate)
+    
+    # One counter reservation per company and invoice type; numbers of items that fail to insert are skipped
+    owners = await case_owners([invoice_data.case_id for _, invoice_data in valid])
+    groups: Dict[tuple, list] = {}
+    for index, invoice_data in valid:
+        owner = owners.get(invoice_data.case_id) or {}
+        groups.setdefault((owner.get("company_id"), invoice_data.type), []).append((index, invoice_data))
+    rows = []
+    for (company_id, invoice_type), group in groups.items():
+        numbers = await invoice_numbers.allocate(company_id, invoice_type, count=len(group))
+        rows.extend(
+            (index, build_invoice(invoice_data, owners.get(invoice_data.case_id), number).model_dump())
+            for (index, invoice_data), number in zip(group, numbers)
+        )
+    rows.sort(key=lambda row: row[0])
+    
+    written = await insert_unordered(db.invoices, rows, report)
+    await company_stats.invoices_added(written)
+    return report.as_dict()
+
 @api_router.get("/cases/{case_id}/invoices", response_model=List[Invoice])
-async def get_invoices(case_id: str, user: User = Depends(get_current_user)):
-    invoices = await db.invoices.find({"case_id": case_id}, {"_id": 0}).to_list(1000)
-    return [Invoice(**inv) for inv in invoices]
+async def get_invoices(
+    case_id: str,
+    response: Response,
+    status: Optional[str] = None,
+    type: Optional[str] = None,
+    sort: str = "issued_date",
+    limit: int = Query(MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    fields: Optional[str] = None,
+    user: AuthUser = Depends(get_current_user)
+):
+    query = {"case_id": case_id, **filters(status=status, type=type)}
+    return await paginate(db.invoices, query, Invoice, response, sort=sort, limit=limit, after=after, fields=fields)
 
 @api_router.put("/invoices/{invoice_id}")
-async def update_invoice_status(invoice_id: str, update_data: dict, user: User = Depends(get_current_user)):
+async def update_invoice_status(invoice_id: str, update_data: dict, user: AuthUser = Depends(get_current_user)):
     # Allow updating all fields or just status
     allowed_fields = ["status", "type", "amount", "vat_percentage", "description_ar", "due_date"]
     update_fields = {k: v for k, v in update_data.items() if k in allowed_fields}
     
     # Recalculate totals if amount or vat changed
-    if "amount" in update_fields or "vat_percentage" in update_fields:
-        invoice = await db.invoices.find_one({"id": invoice_id}, {"_id": 0})
-        if not invoice:
+    if "amount" not in update_fields and "vat_percentage" not in update_fields:
+        before = await db.invoices.find_one_and_update(
+            {"id": invoice_id},
+            {"$set": update_fields},
+            projection={"_id": 0},
+            return_document=ReturnDocument.BEFORE
+        )
+        if not before:
             raise HTTPException(status_code=404, detail="Invoice not found")
-        
-        amount = update_fields.get("amount", invoice["amount"])
-        vat_percentage = update_fields.get("vat_percentage", (invoice["vat_amount"] / invoice["amount"]) * 100)
-        
-        vat_amount = amount * (vat_percentage / 100)
-        total_amount = amount + vat_amount
-        
-        update_fields["vat_amount"] = vat_amount
-        update_fields["total_amount"] = total_amount
+        updated = {**before, **update_fields}
+        await company_stats.invoice_changed(before, updated)
+        return Invoice(**updated)
     
-    await db.invoices.update_one({"id": invoice_id}, {"$set": update_fields})
-    updated = await db.invoices.find_one({"id": invoice_id}, {"_id": 0})
+    # One pipeline update, like apply_payment: totals, balance and status all come
+    # from the stored amount_paid, so a concurrent payment can't be lost
+    amount = {"$literal": update_fields["amount"]} if "amount" in update_fields else "$amount"
+    if "vat_percentage" in update_fields:
+        vat_rate = {"$literal": update_fields["vat_percentage"] / 100}
+    else:
+        vat_rate = {"$cond": [{"$eq": ["$amount", 0]}, 0, {"$divide": ["$vat_amount", "$amount"]}]}
+    other_fields = {k: {"$literal": v} for k, v in update_fields.items() if k not in ("amount", "vat_percentage", "status")}
+    pipeline = [
+        {"$set": {**other_fields, "amount": amount, "vat_amount": {"$multiply": [amount, vat_rate]}}},
+        {"$set": {"total_amount": {"$add": ["$amount", "$vat_amount"]}}},
+        {"$set": {
+            "balance_due": {"$subtract": ["$total_amount", {"$ifNull": ["$amount_paid", 0]}]},
+            # An explicit status in the request still wins
+            "status": {"$literal": update_fields["status"]} if "status" in update_fields
+            else payment_status_expr({"$ifNull": ["$amount_paid", 0]}, "$total_amount")
+        }}
+    ]
+    before = await db.invoices.find_one_and_update(
+        {"id": invoice_id},
+        pipeline,
+        projection={"_id": 0},
+        return_document=ReturnDocument.BEFORE
+    )
+    if not before:
+        raise HTTPException(status_code=404, detail="Invoice not found")
+    
+    new_amount = update_fields.get("amount", before["amount"])
+    if "vat_percentage" in update_fields:
+        rate = update_fields["vat_percentage"] / 100
+    else:
+        rate = before["vat_amount"] / before["amount"] if before["amount"] else 0
+    vat_amount = new_amount * rate
+    total_amount = new_amount + vat_amount
+    amount_paid = before.get("amount_paid", 0.0)
+    updated = {
+        **before,
+        **update_fields,
+        "amount": new_amount,
+        "vat_amount": vat_amount,
+        "total_amount": total_amount,
+        "balance_due": total_amount - amount_paid,
+        "status": update_fields.get("status", payment_status(amount_paid, total_amount))
+    }
+    await company_stats.invoice_changed(before, updated)
     return Invoice(**updated)
 
 @api_router.delete("/invoices/{invoice_id}")
-async def delete_invoice(invoice_id: str, user: User = Depends(get_current_user)):
+async def delete_invoice(invoice_id: str, user: AuthUser = Depends(get_current_user)):
     # Delete associated payments first
     await db.payments.delete_many({"invoice_id": invoice_id})
     # Delete invoice
-    result = await db.invoices.delete_one({"id": invoice_id})
-    if result.deleted_count == 0:
+    invoice = await db.invoices.find_one_and_delete({"id": invoice_id}, projection={"_id": 0})
+    if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
+    await company_stats.invoice_changed(invoice, None)
     return {"message": "Invoice deleted successfully"}
 
+def payment_status(amount_paid: float, total_amount: float) -> str:
+    if amount_paid >= total_amount:
+        return "paid"
+    return "partial" if amount_paid > 0 else "pending"
+
+def payment_status_expr(amount_paid, total_amount):
+    return {"$switch": {
+        "branches": [
+            {"case": {"$gte": [amount_paid, total_amount]}, "then": "paid"},
+            {"case": {"$gt": [amount_paid, 0]}, "then": "partial"}
+        ],
+        "default": "pending"
+    }}
+
+async def apply_payment(invoice_id: str, amount: float):
+    # Single pipeline update: bump the paid total, then derive balance and status from it
+    before = await db.invoices.find_one_and_update(
+        {"id": invoice_id},
+        [
+            {"$set": {"amount_paid": {"$add": [{"$ifNull": ["$amount_paid", 0]}, amount]}}},
+            {"$set": {
+                "balance_due": {"$subtract": ["$total_amount", "$amount_paid"]},
+                "status": payment_status_expr("$amount_paid", "$total_amount")
+            }}
+        ],
+        projection={"_id": 0},
+        return_document=ReturnDocument.BEFORE
+    )
+    if not before:
+        return None
+    
+    amount_paid = before.get("amount_paid", 0.0) + amount
+    after = {
+        **before,
+        "amount_paid": amount_paid,
+        "balance_due": before["total_amount"] - amount_paid,
+        "status": payment_status(amount_paid, before["total_amount"])
+    }
+    await company_stats.invoice_changed(before, after)
+    return after
+
 @api_router.post("/payments")
-async def create_payment(payment_data: PaymentCreate, user: User = Depends(get_current_user)):
+async def create_payment(payment_data: PaymentCreate, user: AuthUser = Depends(get_current_user)):
     payment = Payment(**payment_data.model_dump())
     await db.payments.insert_one(payment.model_dump())
-    
-    invoice = await db.invoices.find_one({"id": payment_data.invoice_id}, {"_id": 0})
-    if invoice:
-        payments = await db.payments.find({"invoice_id": payment_data.invoice_id}, {"_id": 0}).to_list(1000)
-        total_paid = sum(p["amount"] for p in payments)
-        
-        if total_paid >= invoice["total_amount"]:
-            await db.invoices.update_one({"id": payment_data.invoice_id}, {"$set": {"status": "paid"}})
-        else:
-            await db.invoices.update_one({"id": payment_data.invoice_id}, {"$set": {"status": "partial"}})
-    
+    await apply_payment(payment.invoice_id, payment.amount)
     return payment
 
+@api_router.post("/payments/bulk")
+async def create_payments_bulk(items: List[Dict[str, Any]], user: AuthUser = Depends(get_current_user)):
+    check_bulk_size(items)
+    report = BulkReport(len(items))
+    rows = [
+        (index, Payment(**payment_data.model_dump()).model_dump())
+        for index, payment_data in report.validate(items, PaymentCreate)
+    ]
+    written = await insert_unordered(db.payments, rows, report)
+    
+    # Apply each invoice's payments as one amount
+    totals: Dict[str, float] = {}
+    for payment in written:
+        totals[payment["invoice_id"]] = totals.get(payment["invoice_id"], 0.0) + payment["amount"]
+    for invoice_id, amount in totals.items():
+        await apply_payment(invoice_id, amount)
+    return report.as_dict()
+
+@api_router.delete("/payments/{payment_id}")
+async def delete_payment(payment_id: str, user: AuthUser = Depends(get_current_user)):
+    payment = await db.payments.find_one_and_delete({"id": payment_id}, projection={"_id": 0})
+    if not payment:
+        raise HTTPException(status_code=404, detail="Payment not found")
+    await apply_payment(payment["invoice_id"], -payment["amount"])
+    return {"message": "Payment deleted"}
+
 @api_router.get("/cases/{case_id}/payments", response_model=List[Payment])
-async def get_payments(case_id: str, user: User = Depends(get_current_user)):
-    payments = await db.payments.find({"case_id": case_id}, {"_id": 0}).to_list(1000)
-    return [Payment(**pay) for pay in payments]
+async def get_payments(
+    case_id: str,
+    response: Response,
+    invoice_id: Optional[str] = None,
+    method: Optional[str] = None,
+    sort: str = "payment_date",
+    limit: int = Query(MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    fields: Optional[str] = None,
+    user: AuthUser = Depends(get_current_user)
+):
+    query = {"case_id": case_id, **filters(invoice_id=invoice_id, method=method)}
+    return await paginate(db.payments, query, Payment, response, sort=sort, limit=limit, after=after, fields=fields)
 
 @api_router.post("/templates")
-async def create_template(template_data: TemplateCreate, user: User = Depends(get_current_user)):
+async def create_template(template_data: TemplateCreate, user: AuthUser = Depends(get_current_user)):
     if user.role != "admin":
         raise HTTPException(status_code=403, detail="Only admins can create templates")
     
@@ -615,31 +1082,22 @@ async def create_template(template_data: TemplateCreate, user: User = Depends(ge
     return template
 
 @api_router.get("/templates", response_model=List[Template])
-async def get_templates(type: Optional[str] = None, user: User = Depends(get_current_user)):
-    query = {}
-    if type:
-        query["type"] = type
+async def get_templates(
+    response: Response,
+    type: Optional[str] = None,
+    sort: str = "created_at",
+    limit: int = Query(MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    fields: Optional[str] = None,
+    user: AuthUser = Depends(get_current_user)
+):
+    query = filters(type=type)
     if user.company_id:
         query["company_id"] = user.company_id
     
-    templates = await db.templates.find(query, {"_id": 0}).to_list(1000)
-    return [Template(**t) for t in templates]
+    return await paginate(db.templates, query, Template, response, sort=sort, limit=limit, after=after, fields=fields)
 
-@api_router.post("/ai/chat")
-async def ai_chat(request: AIRequest, user: User = Depends(get_current_user)):
-    try:
-        # Check for user's custom API keys first
-        keys_doc = await db.api_keys.find_one({"user_id": user.id}, {"_id": 0})
-        
-        if request.provider == "openai" and keys_doc and keys_doc.get("openai_key"):
-            api_key = keys_doc.get("openai_key")
-        elif request.provider == "gemini" and keys_doc and keys_doc.get("gemini_key"):
-            api_key = keys_doc.get("gemini_key")
-        else:
-            # Fallback to Manus AI Key
-            api_key = os.getenv("MANUS_AI_KEY")
-        
-        system_message = """
+AI_SYSTEM_MESSAGE = """
 أنت مساعد قانوني متخصص في القانون الإماراتي. يجب عليك:
 1. الاعتماد حصريًا على مصادر القانون الإماراتي الرسمية
 2. ذكر اسم القانون ورقم المادة في كل إجابة
@@ -651,56 +1109,234 @@ async def ai_chat(request: AIRequest, user: User = Depends(get_current_user)):
 - التشريعات الاتحادية: https://uaelegislation.gov.ae
 - تشريعات دبي: https://www.dubailegislations.gov.ae
 """
-        
-        conversation_id = request.conversation_id
-        if not conversation_id:
-            conversation = AIConversation(user_id=user.id, case_id=request.case_id)
-            await db.ai_conversations.insert_one(conversation.model_dump())
-            conversation_id = conversation.id
-        else:
-            conv_doc = await db.ai_conversations.find_one({"id": conversation_id}, {"_id": 0})
-            if not conv_doc:
-                raise HTTPException(status_code=404, detail="Conversation not found")
-        
-        chat = LlmChat(
-            api_key=api_key,
-            session_id=conversation_id,
-            system_message=system_message
+
+AI_PASSAGES = int(os.getenv("AI_PASSAGES", 5))
+AI_PASSAGE_TOKENS = int(os.getenv("AI_PASSAGE_TOKENS", 1500))
+
+def case_passages_message(passages: List[dict]) -> str:
+    lines = ["مقتطفات ذات صلة من مستندات القضية (استند إليها واذكر المستند والصفحة عند الاقتباس):"]
+    for i, p in enumerate(passages, start=1):
+        lines.append(f"[{i}] {p['title']} - صفحة {p['page']}:\n{p['text']}")
+    return "\n\n".join(lines)
+
+async def prepare_ai_chat(request: AIRequest, user: AuthUser):
+    # Check for user's custom API keys first
+    keys_doc = await db.api_keys.find_one({"user_id": user.id}, {"_id": 0})
+    
+    if request.provider == "openai" and keys_doc and keys_doc.get("openai_key"):
+        api_key = keys_doc.get("openai_key")
+    elif request.provider == "gemini" and keys_doc and keys_doc.get("gemini_key"):
+        api_key = keys_doc.get("gemini_key")
+    else:
+        # Fallback to Manus AI Key
+        api_key = os.getenv("MANUS_AI_KEY")
+    
+    conversation_id = request.conversation_id
+    case_id = request.case_id
+    if not conversation_id:
+        conversation = AIConversation(user_id=user.id, case_id=request.case_id)
+        await db.ai_conversations.insert_one(conversation.model_dump())
+        conversation_id = conversation.id
+    else:
+        conv_doc = await db.ai_conversations.find_one({"id": conversation_id}, {"_id": 0, "id": 1, "case_id": 1})
+        if not conv_doc:
+            raise HTTPException(status_code=404, detail="Conversation not found")
+        case_id = case_id or conv_doc.get("case_id")
+        await conversation_store.migrate_legacy(conversation_id)
+    
+    history = await conversation_store.build_context(conversation_id)
+    if case_id:
+        passages = await search_index.retrieve(case_id, request.message, k=AI_PASSAGES, token_budget=AI_PASSAGE_TOKENS)
+        if passages:
+            history.append({"role": "system", "content": case_passages_message(passages)})
+    
+    chat = LlmChat(
+        api_key=api_key,
+        session_id=conversation_id,
+        system_message=AI_SYSTEM_MESSAGE
+    ).with_history(history)
+    
+    if request.provider == "openai":
+        chat.with_model("openai", request.model)
+    elif request.provider == "gemini":
+        chat.with_model("gemini", request.model if request.model != "gpt-5.2" else "gemini-3-pro-preview")
+    
+    return chat, conversation_id
+
+# Fire-and-forget writes; the event loop only holds weak references to tasks
+background_tasks = set()
+
+def run_in_background(coro, description: str):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    
+    def report(task):
+        if not task.cancelled() and task.exception():
+            logger.error(f"{description} failed: {task.exception()}")
+    task.add_done_callback(report)
+    return task
+
+async def save_ai_turn(chat: LlmChat, conversation_id: str, user_text: str, assistant_text: str, **extra):
+    now = datetime.now(timezone.utc).isoformat()
+    await conversation_store.append(conversation_id, [
+        {"role": "user", "content": user_text, "timestamp": now},
+        {"role": "assistant", "content": assistant_text, "timestamp": now, **extra}
+    ])
+    if chat.has_key:
+        run_in_background(
+            conversation_store.maybe_summarize(conversation_id, chat.summarize),
+            f"Summarizing conversation {conversation_id}"
         )
+
+def response_cache_key(request: AIRequest, chat: LlmChat) -> Optional[str]:
+    # Case-bound chats and follow-ups depend on more than the prompt itself
+    if not (ai_cache.enabled and chat.has_key) or request.case_id or chat.history:
+        ai_cache.bypass()
+        return None
+    return cache_key(chat.system_message, chat.model_provider, chat.model_name, request.message)
+
+def provider_failure(error: Exception) -> bool:
+    # Only outages and throttling count against the provider, not bad keys or requests
+    return isinstance(error, RETRYABLE_ERRORS)
+
+def ai_tenant(user: AuthUser) -> str:
+    return user.company_id or user.id
+
+def rejection_error(e: AIRejected) -> HTTPException:
+    headers = {"Retry-After": str(math.ceil(e.retry_after))} if e.retry_after else None
+    return HTTPException(status_code=e.status_code, detail=e.detail, headers=headers)
+
+@api_router.post("/ai/chat")
+async def ai_chat(request: AIRequest, user: AuthUser = Depends(get_current_user)):
+    try:
+        chat, conversation_id = await prepare_ai_chat(request, user)
         
-        if request.provider == "openai":
-            chat.with_model("openai", request.model)
-        elif request.provider == "gemini":
-            chat.with_model("gemini", request.model if request.model != "gpt-5.2" else "gemini-3-pro-preview")
+        key = response_cache_key(request, chat)
+        response = await ai_cache.get(key) if key else None
+        if response is None:
+            user_message = UserMessage(text=request.message)
+            async with ai_gate.slot(user.id, ai_tenant(user), chat.model_provider, provider_failure):
+                response = await chat.send_message(user_message)
+            if key and response:
+                await ai_cache.set(key, response)
         
-        user_message = UserMessage(text=request.message)
-        response = await chat.send_message(user_message)
-        
-        await db.ai_conversations.update_one(
-            {"id": conversation_id},
-            {"$push": {
-                "messages": [
-                    {"role": "user", "content": request.message, "timestamp": datetime.now(timezone.utc).isoformat()},
-                    {"role": "assistant", "content": response, "timestamp": datetime.now(timezone.utc).isoformat()}
-                ]
-            }}
-        )
+        await save_ai_turn(chat, conversation_id, request.message, response)
         
         return {"response": response, "conversation_id": conversation_id}
     
+    except AIRejected as e:
+        raise rejection_error(e)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"AI chat failed: {e}")
-        raise HTTPException(status_code=500, detail=f"AI chat failed: {str(e)}")
+        raise HTTPException(status_code=502 if provider_failure(e) else 500, detail=f"AI chat failed: {str(e)}")
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@api_router.post("/ai/chat/stream")
+async def ai_chat_stream(request: AIRequest, user: AuthUser = Depends(get_current_user)):
+    chat, conversation_id = await prepare_ai_chat(request, user)
+    key = response_cache_key(request, chat)
+    cached = await ai_cache.get(key) if key else None
+    if cached is None:
+        try:
+            ai_gate.admit(user.id, chat.model_provider)
+        except AIRejected as e:
+            raise rejection_error(e)
+    
+    async def events():
+        parts = []
+        completed = False
+        try:
+            yield sse_event("start", {"conversation_id": conversation_id})
+            if cached is not None:
+                parts.append(cached)
+                yield sse_event("token", {"text": cached})
+            else:
+                # The slot is taken inside the stream so it is always released
+                async with ai_gate.running(ai_tenant(user), chat.model_provider, provider_failure):
+                    async for delta in chat.stream_message(UserMessage(text=request.message)):
+                        parts.append(delta)
+                        yield sse_event("token", {"text": delta})
+                if key and parts:
+                    await ai_cache.set(key, "".join(parts))
+            completed = True
+            yield sse_event("done", {"conversation_id": conversation_id})
+        except AIRejected as e:
+            yield sse_event("error", {"detail": e.detail, "retry_after": e.retry_after})
+        except Exception as e:
+            logger.error(f"AI chat stream failed: {e}")
+            yield sse_event("error", {"detail": f"AI chat failed: {str(e)}"})
+        finally:
+            # Runs on disconnect too, where this generator is being cancelled;
+            # the write is scheduled as its own task so it is not cancelled with it.
+            if completed:
+                await save_ai_turn(chat, conversation_id, request.message, "".join(parts))
+            elif parts:
+                run_in_background(
+                    save_ai_turn(chat, conversation_id, request.message, "".join(parts), interrupted=True),
+                    f"Saving interrupted turn of conversation {conversation_id}"
+                )
+            else:
+                logger.info(f"AI chat stream for {conversation_id} ended before any output")
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@api_router.get("/ai/metrics")
+async def get_ai_metrics(user: AuthUser = Depends(get_current_user)):
+    if user.role != "admin":
+        raise HTTPException(status_code=403, detail="Only admins can view AI metrics")
+    return {**ai_gate.metrics(), "cache": ai_cache.stats()}
+
+@api_router.get("/ai/cache/stats")
+async def get_ai_cache_stats(user: AuthUser = Depends(get_current_user)):
+    if user.role != "admin":
+        raise HTTPException(status_code=403, detail="Only admins can view AI cache stats")
+    return ai_cache.stats()
 
 @api_router.get("/ai/conversations/{conversation_id}")
-async def get_conversation(conversation_id: str, user: User = Depends(get_current_user)):
+async def get_conversation(
+    conversation_id: str,
+    response: Response,
+    limit: int = Query(50, ge=0, le=500),
+    user: AuthUser = Depends(get_current_user)
+):
+    # Carries the latest page of messages; older ones come from /messages
+    await conversation_store.migrate_legacy(conversation_id)
     conv = await db.ai_conversations.find_one({"id": conversation_id}, {"_id": 0})
     if not conv:
         raise HTTPException(status_code=404, detail="Conversation not found")
+    conv["messages"], before = await conversation_store.page(conversation_id, limit)
+    if before is not None:
+        response.headers[NEXT_CURSOR_HEADER] = str(before)
     return AIConversation(**conv)
 
+@api_router.get("/ai/conversations/{conversation_id}/messages")
+async def get_conversation_messages(
+    conversation_id: str,
+    response: Response,
+    limit: int = Query(50, ge=1, le=500),
+    before: Optional[int] = Query(None, ge=0),
+    user: AuthUser = Depends(get_current_user)
+):
+    conv = await db.ai_conversations.find_one({"id": conversation_id}, {"_id": 0, "id": 1})
+    if not conv:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    await conversation_store.migrate_legacy(conversation_id)
+    messages, next_before = await conversation_store.page(conversation_id, limit, before)
+    if next_before is not None:
+        response.headers[NEXT_CURSOR_HEADER] = str(next_before)
+    return messages
+
 @api_router.get("/drive/connect")
-async def connect_drive(user: User = Depends(get_current_user)):
+async def connect_drive(user: AuthUser = Depends(get_current_user)):
     try:
         redirect_uri = os.getenv("GOOGLE_DRIVE_REDIRECT_URI")
         
@@ -774,31 +1410,58 @@ async def drive_callback(code: str = Query(...), state: str = Query(...)):
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"OAuth failed: {str(e)}")
 
-@api_router.get("/stats")
-async def get_stats(user: User = Depends(get_current_user)):
-    query = {}
-    if user.company_id:
-        query["company_id"] = user.company_id
+@api_router.post("/documents/{doc_id}/drive")
+async def sync_document_to_drive(doc_id: str, user: AuthUser = Depends(get_current_user)):
+    if not await db.drive_credentials.find_one({"user_id": user.id}, {"_id": 0, "user_id": 1}):
+        raise HTTPException(status_code=400, detail="Google Drive is not connected")
+    doc = await db.documents.find_one({"id": doc_id}, {"_id": 0, "id": 1, "storage_key": 1, "file_name": 1, "file_size": 1})
+    if not doc:
+        raise HTTPException(status_code=404, detail="Document not found")
+    if not doc.get("storage_key"):
+        raise HTTPException(status_code=409, detail="Document file is not available in storage")
+    job = await db.drive_jobs.find_one({"doc_id": doc_id}, {"_id": 0, "status": 1})
+    if job and job["status"] in ("pending", "running"):
+        return {"document_id": doc_id, "drive_status": job["status"]}
     
-    total_cases = await db.cases.count_documents(query)
-    active_cases = await db.cases.count_documents({**query, "status": "active"})
-    total_invoices = await db.invoices.count_documents({})
-    pending_invoices = await db.invoices.count_documents({"status": "pending"})
+    await drive_sync.enqueue(doc, user.id)
+    return {"document_id": doc_id, "drive_status": "pending"}
+
+@api_router.get("/drive/sync/status")
+async def get_drive_sync_status(user: AuthUser = Depends(get_current_user)):
+    counts = {}
+    async for row in db.drive_jobs.aggregate([
+        {"$match": {"user_id": user.id}},
+        {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+    ]):
+        counts[row["_id"]] = row["count"]
     
-    total_revenue = 0
-    invoices = await db.invoices.find({"status": "paid"}, {"_id": 0}).to_list(10000)
-    total_revenue = sum(inv["total_amount"] for inv in invoices)
+    active = await db.drive_jobs.find(
+        {"user_id": user.id, "status": {"$in": ["pending", "running", "failed"]}},
+        {"_id": 0, "doc_id": 1, "file_name": 1, "status": 1, "size": 1, "progress": 1,
+         "attempts": 1, "error": 1, "next_attempt_at": 1}
+    ).sort("updated_at", -1).to_list(100)
+    return {"counts": counts, "jobs": active}
+
+@api_router.get("/stats")
+async def get_stats(user: AuthUser = Depends(get_current_user)):
+    return await company_stats.get(user.company_id)
+
+@api_router.get("/admin/export")
+async def export_company(user: AuthUser = Depends(get_current_user)):
+    if user.role != "admin":
+        raise HTTPException(status_code=403, detail="Only admins can export company data")
+    if not user.company_id:
+        raise HTTPException(status_code=400, detail="No company to export")
     
-    return {
-        "total_cases": total_cases,
-        "active_cases": active_cases,
-        "total_invoices": total_invoices,
-        "pending_invoices": pending_invoices,
-        "total_revenue": total_revenue
-    }
+    file_name = f"export-{user.company_id}-{datetime.now(timezone.utc):%Y%m%d%H%M%S}.zip"
+    return StreamingResponse(
+        stream_export(db, user.company_id, storage),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{file_name}"'}
+    )
 
 @api_router.get("/settings/api-keys")
-async def get_api_keys(user: User = Depends(get_current_user)):
+async def get_api_keys(user: AuthUser = Depends(get_current_user)):
     keys_doc = await db.api_keys.find_one({"user_id": user.id}, {"_id": 0})
     if not keys_doc:
         return {
@@ -816,7 +1479,7 @@ async def get_api_keys(user: User = Depends(get_current_user)):
     }
 
 @api_router.post("/settings/api-keys")
-async def save_api_keys(keys_data: dict, user: User = Depends(get_current_user)):
+async def save_api_keys(keys_data: dict, user: AuthUser = Depends(get_current_user)):
     allowed_keys = ["openai_key", "gemini_key", "google_drive_client_id", "google_drive_client_secret"]
     update_data = {k: v for k, v in keys_data.items() if k in allowed_keys and v and str(v).strip()}
     
@@ -844,6 +1507,7 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER, "ETag", "Content-Range", "Accept-Ranges", "Content-Disposition"],
 )
 
 logging.basicConfig(
@@ -851,8 +1515,28 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 
+@app.on_event("startup")
+async def start_background_services():
+    legacy = await unmigrated_collections(db)
+    if legacy:
+        # Readers only understand storage keys; serving these would 404 or fail mid-export
+        raise RuntimeError(
+            f"Uploads in {', '.join(legacy)} still use file paths; run manage.py migrate-storage-keys first"
+        )
+    await ensure_indexes(db)
+    await auth_cache.start()
+    await ocr_pool.start()
+    await drive_sync.start()
+    await start_pool()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await drive_sync.stop()
+    await ocr_pool.stop()
+    await auth_cache.stop()
+    await close_clients()
+    close_pool()
     client.close()
 if __name__ == "__main__":
     import uvicorn
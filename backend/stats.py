@@ -0,0 +1,128 @@
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+STAT_FIELDS = ["total_cases", "active_cases", "total_invoices", "pending_invoices", "total_revenue"]
+
+
+def _count(match: dict) -> list:
+    return [{"$match": match}, {"$count": "n"}]
+
+
+def _case_contrib(case: Optional[dict]) -> dict:
+    if not case:
+        return {"total_cases": 0, "active_cases": 0}
+    return {"total_cases": 1, "active_cases": 1 if case.get("status") == "active" else 0}
+
+
+def _invoice_contrib(invoice: Optional[dict]) -> dict:
+    if not invoice:
+        return {"total_invoices": 0, "pending_invoices": 0, "total_revenue": 0}
+    return {
+        "total_invoices": 1,
+        "pending_invoices": 1 if invoice.get("status") == "pending" else 0,
+        "total_revenue": invoice.get("total_amount", 0) if invoice.get("status") == "paid" else 0
+    }
+
+
+class CompanyStats:
+    """Dashboard counters for a company.
+
+    ``compute`` answers in one aggregation: cases are unioned with invoices
+    and split by a ``$facet``. With ``STATS_MATERIALIZED`` enabled the result
+    is also kept in ``company_stats`` and adjusted by every case, invoice and
+    payment write, so the dashboard reads a single document.
+    """
+
+    def __init__(self, db, materialized: bool = None):
+        self.db = db
+        if materialized is None:
+            materialized = os.getenv("STATS_MATERIALIZED", "false").lower() in ("1", "true", "yes")
+        self.materialized = materialized
+
+    async def compute(self, company_id: Optional[str]) -> dict:
+        scope = {"company_id": company_id} if company_id else {}
+        pipeline = [
+            {"$match": scope},
+            {"$project": {"_id": 0, "kind": {"$literal": "case"}, "status": 1}},
+            {"$unionWith": {"coll": "invoices", "pipeline": [
+                {"$match": scope},
+                {"$project": {"_id": 0, "kind": {"$literal": "invoice"}, "status": 1, "total_amount": 1}}
+            ]}},
+            {"$facet": {
+                "total_cases": _count({"kind": "case"}),
+                "active_cases": _count({"kind": "case", "status": "active"}),
+                "total_invoices": _count({"kind": "invoice"}),
+                "pending_invoices": _count({"kind": "invoice", "status": "pending"}),
+                "total_revenue": [
+                    {"$match": {"kind": "invoice", "status": "paid"}},
+                    {"$group": {"_id": None, "n": {"$sum": "$total_amount"}}}
+                ]
+            }}
+        ]
+        rows = await self.db.cases.aggregate(pipeline).to_list(1)
+        facets = rows[0] if rows else {}
+        return {field: (facets.get(field) or [{"n": 0}])[0]["n"] for field in STAT_FIELDS}
+
+    async def get(self, company_id: Optional[str]) -> dict:
+        if not (self.materialized and company_id):
+            return await self.compute(company_id)
+
+        doc = await self.db.company_stats.find_one({"_id": company_id})
+        if doc:
+            return {field: doc.get(field, 0) for field in STAT_FIELDS}
+        return await self.rebuild(company_id)
+
+    async def rebuild(self, company_id: str) -> dict:
+        stats = await self.compute(company_id)
+        doc = {**stats, "updated_at": datetime.now(timezone.utc).isoformat()}
+        try:
+            await self.db.company_stats.replace_one({"_id": company_id}, doc, upsert=True)
+        except DuplicateKeyError:
+            pass
+        return stats
+
+    async def _inc(self, company_id: Optional[str], deltas: dict):
+        # Only adjust documents that exist; missing ones are built on first read
+        deltas = {k: v for k, v in deltas.items() if v}
+        if not (self.materialized and company_id and deltas):
+            return
+        await self.db.company_stats.update_one(
+            {"_id": company_id},
+            {"$inc": deltas, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
+        )
+
+    async def _inc_added(self, docs: List[dict], contrib):
+        # One $inc per company for a batch of new documents
+        totals = defaultdict(lambda: defaultdict(float))
+        for doc in docs:
+            for field, value in contrib(doc).items():
+                totals[doc.get("company_id")][field] += value
+        for company_id, deltas in totals.items():
+            await self._inc(company_id, dict(deltas))
+
+    async def case_changed(self, before: Optional[dict], after: Optional[dict]):
+        doc = after or before
+        if not doc:
+            return
+        old, new = _case_contrib(before), _case_contrib(after)
+        await self._inc(doc.get("company_id"), {k: new[k] - old[k] for k in new})
+
+    async def cases_added(self, docs: List[dict]):
+        await self._inc_added(docs, _case_contrib)
+
+    async def invoices_added(self, docs: List[dict]):
+        await self._inc_added(docs, _invoice_contrib)
+
+    async def invoice_changed(self, before: Optional[dict], after: Optional[dict]):
+        doc = after or before
+        if not doc:
+            return
+        old, new = _invoice_contrib(before), _invoice_contrib(after)
+        await self._inc(doc.get("company_id"), {k: new[k] - old[k] for k in new})
@@ -0,0 +1,387 @@
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import AsyncIterator, List, Optional
+
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+# S3 multipart parts must be at least 5 MiB, except the last
+S3_PART_SIZE = int(os.getenv("S3_PART_SIZE", 8 * 1024 * 1024))
+# How long put waits on another process's delete of the same blob before taking it over
+DELETE_WAIT = 30.0
+# Fields that held absolute upload paths before storage keys (manage.py migrate-storage-keys)
+LEGACY_PATH_FIELDS = [
+    ("documents", "file_path"),
+    ("blobs", "path"),
+    ("ocr_jobs", "file_path"),
+    ("drive_jobs", "file_path"),
+]
+
+
+def blob_key(sha256: str) -> str:
+    return f"blobs/{sha256[:2]}/{sha256}"
+
+
+async def unmigrated_collections(db) -> List[str]:
+    """Collections that still have records pointing at files by path instead of storage key."""
+    return [
+        collection for collection, field in LEGACY_PATH_FIELDS
+        if await db[collection].find_one({field: {"$exists": True}}, {"_id": 1})
+    ]
+
+
+async def file_chunks(path: Path, start: int = 0, length: Optional[int] = None) -> AsyncIterator[bytes]:
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length is None or length > 0:
+            size = CHUNK_SIZE if length is None else min(CHUNK_SIZE, length)
+            data = await asyncio.to_thread(f.read, size)
+            if not data:
+                break
+            if length is not None:
+                length -= len(data)
+            yield data
+
+
+class LocalStorage:
+    """Files on local disk; keys are paths relative to ``root``."""
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.tmp_dir = self.root / "tmp"
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        path = (self.root / key).resolve()
+        if not path.is_relative_to(self.root.resolve()):
+            raise ValueError(f"Storage key escapes the storage root: {key}")
+        return path
+
+    async def write(self, key: str, chunks: AsyncIterator[bytes]) -> int:
+        path = self._path(key)
+        tmp_path = self.tmp_dir / f"{uuid.uuid4()}.part"
+        size = 0
+        try:
+            with open(tmp_path, "wb") as out:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    await asyncio.to_thread(out.write, chunk)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_path, path)
+            return size
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+    def read(self, key: str, start: int = 0, length: Optional[int] = None) -> AsyncIterator[bytes]:
+        return file_chunks(self._path(key), start, length)
+
+    async def stat(self, key: str) -> Optional[dict]:
+        try:
+            st = await asyncio.to_thread(os.stat, self._path(key))
+        except FileNotFoundError:
+            return None
+        return {"size": st.st_size, "mtime": st.st_mtime}
+
+    async def delete(self, key: str):
+        try:
+            await asyncio.to_thread(self._path(key).unlink)
+        except FileNotFoundError:
+            pass
+
+    async def local_path(self, key: str) -> Optional[Path]:
+        path = self._path(key)
+        return path if await asyncio.to_thread(path.exists) else None
+
+    @asynccontextmanager
+    async def local_copy(self, key: str):
+        yield self._path(key)
+
+
+class S3Storage:
+    """S3-compatible object store (AWS, MinIO, R2...) selected by ``endpoint_url``.
+
+    boto3 is synchronous, so every call runs in a thread. Writes stream
+    through a multipart upload one part at a time.
+    """
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: str = None, region: str = None, client=None):
+        if client is None:
+            import boto3
+            client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    async def write(self, key: str, chunks: AsyncIterator[bytes]) -> int:
+        buf = bytearray()
+        size = 0
+        upload_id = None
+        parts = []
+
+        async def flush():
+            nonlocal upload_id
+            if upload_id is None:
+                upload = await asyncio.to_thread(
+                    self.client.create_multipart_upload, Bucket=self.bucket, Key=self._key(key)
+                )
+                upload_id = upload["UploadId"]
+            number = len(parts) + 1
+            part = await asyncio.to_thread(
+                self.client.upload_part, Bucket=self.bucket, Key=self._key(key),
+                UploadId=upload_id, PartNumber=number, Body=bytes(buf)
+            )
+            parts.append({"ETag": part["ETag"], "PartNumber": number})
+            buf.clear()
+
+        try:
+            async for chunk in chunks:
+                buf.extend(chunk)
+                size += len(chunk)
+                if len(buf) >= S3_PART_SIZE:
+                    await flush()
+            if upload_id is None:
+                await asyncio.to_thread(self.client.put_object, Bucket=self.bucket, Key=self._key(key), Body=bytes(buf))
+                return size
+            if buf:
+                await flush()
+            await asyncio.to_thread(
+                self.client.complete_multipart_upload, Bucket=self.bucket, Key=self._key(key),
+                UploadId=upload_id, MultipartUpload={"Parts": parts}
+            )
+            return size
+        except BaseException:
+            if upload_id is not None:
+                await asyncio.to_thread(
+                    self.client.abort_multipart_upload, Bucket=self.bucket, Key=self._key(key), UploadId=upload_id
+                )
+            raise
+
+    async def read(self, key: str, start: int = 0, length: Optional[int] = None) -> AsyncIterator[bytes]:
+        params = {"Bucket": self.bucket, "Key": self._key(key)}
+        if start or length is not None:
+            end = "" if length is None else start + length - 1
+            params["Range"] = f"bytes={start}-{end}"
+        obj = await asyncio.to_thread(self.client.get_object, **params)
+        body = obj["Body"]
+        try:
+            while True:
+                data = await asyncio.to_thread(body.read, CHUNK_SIZE)
+                if not data:
+                    break
+                yield data
+        finally:
+            body.close()
+
+    async def stat(self, key: str) -> Optional[dict]:
+        try:
+            head = await asyncio.to_thread(self.client.head_object, Bucket=self.bucket, Key=self._key(key))
+        except Exception as e:
+            if getattr(e, "response", {}).get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        return {"size": head["ContentLength"], "mtime": head["LastModified"].timestamp()}
+
+    async def delete(self, key: str):
+        await asyncio.to_thread(self.client.delete_object, Bucket=self.bucket, Key=self._key(key))
+
+    async def local_path(self, key: str) -> Optional[Path]:
+        return None
+
+    @asynccontextmanager
+    async def local_copy(self, key: str):
+        # For tools that need a real file (OCR, Drive uploads)
+        fd, name = tempfile.mkstemp(suffix=Path(key).suffix)
+        try:
+            with os.fdopen(fd, "wb") as out:
+                async for data in self.read(key):
+                    await asyncio.to_thread(out.write, data)
+            yield Path(name)
+        finally:
+            os.unlink(name)
+
+
+class TieredStorage:
+    """New files land in ``hot``; ``demote`` moves cold ones to ``cold``.
+
+    Reads try the hot tier first and fall through to the cold one, so a key
+    stays valid wherever its bytes currently live.
+    """
+
+    def __init__(self, hot, cold):
+        self.hot = hot
+        self.cold = cold
+
+    async def _tier(self, key: str):
+        return self.hot if await self.hot.stat(key) is not None else self.cold
+
+    async def write(self, key: str, chunks: AsyncIterator[bytes]) -> int:
+        return await self.hot.write(key, chunks)
+
+    async def read(self, key: str, start: int = 0, length: Optional[int] = None) -> AsyncIterator[bytes]:
+        tier = await self._tier(key)
+        async for data in tier.read(key, start, length):
+            yield data
+
+    async def stat(self, key: str) -> Optional[dict]:
+        return await self.hot.stat(key) or await self.cold.stat(key)
+
+    async def delete(self, key: str):
+        await self.hot.delete(key)
+        await self.cold.delete(key)
+
+    async def local_path(self, key: str) -> Optional[Path]:
+        return await self.hot.local_path(key)
+
+    @asynccontextmanager
+    async def local_copy(self, key: str):
+        async with (await self._tier(key)).local_copy(key) as path:
+            yield path
+
+    async def demote(self, key: str) -> bool:
+        """Copy ``key`` to the cold tier and drop the hot copy; False if it was not hot."""
+        if await self.hot.stat(key) is None:
+            return False
+        await self.cold.write(key, self.hot.read(key))
+        await self.hot.delete(key)
+        return True
+
+
+def storage_from_env(root: Path):
+    """STORAGE_BACKEND=local (default), s3, or tiered (local hot tier, S3 cold tier)."""
+    backend = os.getenv("STORAGE_BACKEND", "local")
+    if backend == "local":
+        return LocalStorage(root)
+
+    s3 = S3Storage(
+        bucket=os.environ["S3_BUCKET"],
+        prefix=os.getenv("S3_PREFIX", ""),
+        endpoint_url=os.getenv("S3_ENDPOINT_URL") or None,
+        region=os.getenv("S3_REGION") or None
+    )
+    if backend == "s3":
+        return s3
+    if backend == "tiered":
+        return TieredStorage(LocalStorage(root), s3)
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
+
+
+class BlobStore:
+    """Content-addressed, reference-counted file store.
+
+    Blobs are stored under ``blobs/<sha[:2]>/<sha>`` in the configured
+    storage backend and tracked in the ``blobs`` collection, which also
+    carries the blob's OCR result so that identical uploads share both the
+    bytes and the OCR run.
+    """
+
+    def __init__(self, db, storage, tmp_dir: Path):
+        self.db = db
+        self.storage = storage
+        self.tmp_dir = Path(tmp_dir)
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+
+    async def put(self, upload, file_ext: str) -> dict:
+        # Spool locally while hashing: the key is only known once the last byte is in
+        digest = hashlib.sha256()
+        size = 0
+        tmp_path = self.tmp_dir / f"{uuid.uuid4()}.part"
+        try:
+            with open(tmp_path, "wb") as out:
+                while True:
+                    chunk = await upload.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    size += len(chunk)
+                    await asyncio.to_thread(out.write, chunk)
+
+            sha256 = digest.hexdigest()
+            key = blob_key(sha256)
+            blob = await self.db.blobs.find_one_and_update(
+                {"sha256": sha256},
+                {
+                    "$inc": {"refcount": 1},
+                    "$setOnInsert": {
+                        "sha256": sha256,
+                        "key": key,
+                        "size": size,
+                        "file_ext": file_ext.lower(),
+                        "ocr_status": None,
+                        "ocr_text": "",
+                        "created_at": datetime.now(timezone.utc).isoformat()
+                    }
+                },
+                upsert=True,
+                projection={"_id": 0},
+                return_document=ReturnDocument.AFTER
+            )
+            blob = await self._wait_for_delete(blob)
+            # Blobs stored before keys were recorded sit at the same relative path
+            blob.setdefault("key", key)
+
+            try:
+                # A first reference always writes: the bytes may belong to a blob that was just released
+                if blob["refcount"] == 1 or await self.storage.stat(key) is None:
+                    await self.storage.write(key, file_chunks(tmp_path))
+            except BaseException:
+                # Hand the reference back, or the blob could never be collected
+                await self.release(sha256)
+                raise
+            return blob
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+    async def _wait_for_delete(self, blob: dict) -> dict:
+        # A release is removing the file; let it finish, then put writes the bytes back
+        deadline = asyncio.get_running_loop().time() + DELETE_WAIT
+        while blob.get("deleting"):
+            if asyncio.get_running_loop().time() > deadline:
+                logger.warning(f"Taking over stale delete of blob {blob['sha256']}")
+                await self.db.blobs.update_one({"sha256": blob["sha256"]}, {"$unset": {"deleting": ""}})
+                blob = {k: v for k, v in blob.items() if k != "deleting"}
+                break
+            await asyncio.sleep(0.05)
+            blob = await self.db.blobs.find_one({"sha256": blob["sha256"]}, {"_id": 0})
+        return blob
+
+    async def release(self, sha256: str):
+        """Drop one reference; the last one removes the file, page text and OCR job.
+
+        The record is tombstoned with ``deleting`` while the file is removed,
+        so a concurrent ``put`` of the same bytes waits and then rewrites the
+        file instead of trusting one that is about to disappear.
+        """
+        await self.db.blobs.update_one({"sha256": sha256}, {"$inc": {"refcount": -1}})
+        orphan = await self.db.blobs.find_one_and_update(
+            {"sha256": sha256, "refcount": {"$lte": 0}, "deleting": {"$ne": True}},
+            {"$set": {"deleting": True}},
+            projection={"_id": 0, "key": 1}
+        )
+        if not orphan:
+            return
+        await self.storage.delete(orphan.get("key") or blob_key(sha256))
+        removed = await self.db.blobs.find_one_and_delete(
+            {"sha256": sha256, "refcount": {"$lte": 0}, "deleting": True},
+            projection={"_id": 0, "sha256": 1}
+        )
+        if not removed:
+            # Re-referenced while the file was going; the waiting put restores it
+            await self.db.blobs.update_one({"sha256": sha256}, {"$unset": {"deleting": ""}})
+            return
+        await self.db.document_pages.delete_many({"sha256": sha256})
+        await self.db.ocr_jobs.delete_one({"sha256": sha256})
+        logger.info(f"Removed unreferenced blob {sha256}")
@@ -0,0 +1,245 @@
+import asyncio
+import io
+import logging
+import zipfile
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import AsyncIterator, List
+
+from bson import json_util
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from storage import blob_key
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+BATCH_SIZE = 500
+CASE_BATCH = 1000
+FLUSH_THRESHOLD = 256 * 1024
+
+# Collections hanging off a case, exported by case_id
+CASE_COLLECTIONS = ["sessions", "documents", "invoices", "payments"]
+
+
+class _StreamBuffer(io.RawIOBase):
+    """Write-only, unseekable sink that ZipFile writes into and we drain."""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self.size = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        self.size = 0
+        return data
+
+
+def _line(doc: dict) -> bytes:
+    return (json_util.dumps(doc, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def _file_member(doc: dict) -> str:
+    if doc.get("sha256"):
+        return f"files/blobs/{doc['sha256']}"
+    return f"files/legacy/{Path(doc.get('storage_key') or doc['file_path']).name}"
+
+
+async def stream_export(db, company_id: str, storage) -> AsyncIterator[bytes]:
+    """Yield a zip archive of one company's data without buffering it.
+
+    Each collection becomes an NDJSON member read from a Motor cursor in
+    batches, and document files are copied into the archive chunk by chunk.
+    Members are written with data descriptors, so nothing is seeked.
+    Documents whose file could not be included are listed under
+    ``skipped_files`` in the manifest, which is written last.
+    """
+    buf = _StreamBuffer()
+    archive = zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+
+    async def write_collection(name: str, cursors):
+        with archive.open(f"{name}.ndjson", "w", force_zip64=True) as member:
+            for cursor in cursors:
+                async for doc in cursor:
+                    member.write(_line(doc))
+                    if buf.size >= FLUSH_THRESHOLD:
+                        yield buf.drain()
+
+    scoped = {"company_id": company_id}
+    async for chunk in write_collection("companies", [db.companies.find({"id": company_id}, {"_id": 0})]):
+        yield chunk
+    async for chunk in write_collection("templates", [db.templates.find(scoped, {"_id": 0}).batch_size(BATCH_SIZE)]):
+        yield chunk
+
+    case_ids = [c["id"] async for c in db.cases.find(scoped, {"_id": 0, "id": 1}).batch_size(BATCH_SIZE)]
+    case_batches = [case_ids[i:i + CASE_BATCH] for i in range(0, len(case_ids), CASE_BATCH)]
+
+    def by_case(collection, projection=None):
+        return [
+            db[collection].find({"case_id": {"$in": batch}}, projection or {"_id": 0}).batch_size(BATCH_SIZE)
+            for batch in case_batches
+        ]
+
+    async for chunk in write_collection("cases", [db.cases.find(scoped, {"_id": 0}).batch_size(BATCH_SIZE)]):
+        yield chunk
+    for collection in CASE_COLLECTIONS:
+        async for chunk in write_collection(collection, by_case(collection)):
+            yield chunk
+
+    # Blob metadata, page text and the files themselves, each blob once
+    shas = set()
+    files = []
+    skipped = []
+    for cursor in by_case("documents", {"_id": 0, "id": 1, "sha256": 1, "storage_key": 1, "file_path": 1}):
+        async for doc in cursor:
+            if doc.get("sha256"):
+                if doc["sha256"] in shas:
+                    continue
+                shas.add(doc["sha256"])
+            key = doc.get("storage_key") or (blob_key(doc["sha256"]) if doc.get("sha256") else None)
+            if not key:
+                # Upload from before storage keys that migrate-storage-keys has not reached
+                logger.warning(f"Export skipped document {doc['id']} without a storage key")
+                skipped.append(doc["id"])
+                continue
+            files.append((doc["id"], _file_member(doc), key))
+
+    sha_list = sorted(shas)
+    sha_batches = [sha_list[i:i + CASE_BATCH] for i in range(0, len(sha_list), CASE_BATCH)]
+    for name in ["blobs", "document_pages"]:
+        cursors = [db[name].find({"sha256": {"$in": batch}}, {"_id": 0}).batch_size(BATCH_SIZE) for batch in sha_batches]
+        async for chunk in write_collection(name, cursors):
+            yield chunk
+
+    for doc_id, member, key in files:
+        if await storage.stat(key) is None:
+            logger.warning(f"Export skipped missing file {key}")
+            skipped.append(doc_id)
+            continue
+        info = zipfile.ZipInfo(member, date_time=datetime.now(timezone.utc).timetuple()[:6])
+        info.compress_type = zipfile.ZIP_STORED
+        with archive.open(info, "w", force_zip64=True) as out:
+            async for data in storage.read(key):
+                out.write(data)
+                if buf.size >= FLUSH_THRESHOLD:
+                    yield buf.drain()
+
+    # Written last so it can list the documents whose files are not in the archive
+    manifest = {
+        "company_id": company_id,
+        "exported_at": datetime.now(timezone.utc).isoformat(),
+        "collections": ["companies", "templates", "cases", *CASE_COLLECTIONS, "blobs", "document_pages"],
+        "skipped_files": skipped
+    }
+    archive.writestr("manifest.json", json_util.dumps(manifest))
+    archive.close()
+    yield buf.drain()
+
+
+async def _insert_batch(collection, docs: List[dict]) -> int:
+    try:
+        result = await collection.insert_many(docs, ordered=False)
+        return len(result.inserted_ids)
+    except BulkWriteError as e:
+        return e.details.get("nInserted", 0)
+
+
+def _restored_key(name: str) -> str:
+    """Storage key for a ``files/`` archive member."""
+    if name.startswith("files/blobs/"):
+        return blob_key(name.rsplit("/", 1)[-1])
+    return f"legacy/{name.rsplit('/', 1)[-1]}"
+
+
+async def _member_chunks(src) -> AsyncIterator[bytes]:
+    while True:
+        data = await asyncio.to_thread(src.read, CHUNK_SIZE)
+        if not data:
+            break
+        yield data
+
+
+async def _recount_blobs(db, shas: List[str]):
+    # Archive refcounts are wrong when a blob already existed here; count the references instead
+    for start in range(0, len(shas), CASE_BATCH):
+        batch = shas[start:start + CASE_BATCH]
+        refs = {
+            row["_id"]: row["n"]
+            async for row in db.documents.aggregate([
+                {"$match": {"sha256": {"$in": batch}}},
+                {"$group": {"_id": "$sha256", "n": {"$sum": 1}}}
+            ])
+        }
+        await db.blobs.bulk_write(
+            [UpdateOne({"sha256": sha}, {"$set": {"refcount": refs.get(sha, 0)}}) for sha in batch],
+            ordered=False
+        )
+
+
+async def restore_export(db, archive_path: Path, storage, search_index=None, company_stats=None) -> dict:
+    """Load an export archive back into ``db`` with batched insert_many.
+
+    Documents that already exist (same unique key) are skipped. Files are
+    written to ``storage`` and storage keys are rewritten to match. Blob
+    refcounts are then recounted, OCR'd documents are indexed for search
+    and the company's stats are rebuilt.
+    """
+    counts = {}
+    shas = set()
+    indexable = []
+    with zipfile.ZipFile(archive_path) as archive:
+        names = set(archive.namelist())
+        manifest = json_util.loads(archive.read("manifest.json"))
+
+        for name in sorted(n for n in names if n.startswith("files/")):
+            with archive.open(name) as src:
+                await storage.write(_restored_key(name), _member_chunks(src))
+
+        for name in sorted(n for n in names if n.endswith(".ndjson")):
+            collection = name[:-len(".ndjson")]
+            inserted = 0
+            batch = []
+            with archive.open(name) as member:
+                for raw in io.TextIOWrapper(member, encoding="utf-8"):
+                    if not raw.strip():
+                        continue
+                    doc = json_util.loads(raw)
+                    if collection == "documents":
+                        doc["storage_key"] = _restored_key(_file_member(doc))
+                        doc.pop("file_path", None)
+                        if doc.get("sha256"):
+                            shas.add(doc["sha256"])
+                        if doc.get("ocr_status") == "done":
+                            indexable.append(doc["id"])
+                    elif collection == "blobs":
+                        doc["key"] = blob_key(doc["sha256"])
+                        doc.pop("path", None)
+                    batch.append(doc)
+                    if len(batch) >= BATCH_SIZE:
+                        inserted += await _insert_batch(db[collection], batch)
+                        batch = []
+            if batch:
+                inserted += await _insert_batch(db[collection], batch)
+            counts[collection] = inserted
+            logger.info(f"Restored {inserted} {collection}")
+
+    await _recount_blobs(db, sorted(shas))
+    if search_index:
+        # document_pages sort before documents, so page text is already in place
+        for doc_id in indexable:
+            doc = await db.documents.find_one({"id": doc_id}, {"_id": 0})
+            if doc:
+                await search_index.index_document(doc)
+    if company_stats:
+        await company_stats.rebuild(manifest["company_id"])
+    return counts